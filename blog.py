@@ -5,75 +5,385 @@
 #######################################################
 
 import os
+import calendar
+import email.utils
+import hashlib
+import json
 import jinja2
 import webapp2
 import signup_helper
+import compile_templates
 import re
 import logging
 import time
 import models
-
+import counters
+import cache
+import sessions
+import migrations
+import search
+import profiling
+import ratelimit
+import ranking
+
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
-template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
-                               autoescape=True)
+COMMENT_MODIFY_RE = re.compile(r"<!--comment-modify:(\d+)-->")
+
+PAGE_SIZE = 10
+MAX_PAGE_SIZE = 50
+COMMENT_PAGE_SIZE = 20
+REPLY_PAGE_SIZE = 100
+
+template_dir = compile_templates.template_dir
+on_dev_server = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+# in production templates are loaded from the modules built by
+# compile_templates.py, skipping the parse and compile on cold starts,
+# as long as they were built from the templates/ deployed with them.
+# The dev server always reads templates/ so edits show up right away
+if not on_dev_server and compile_templates.is_current():
+    template_loader = jinja2.ModuleLoader(compile_templates.compiled_dir)
+else:
+    template_loader = jinja2.FileSystemLoader(template_dir)
+jinja_env = jinja2.Environment(loader=template_loader, autoescape=True)
+
+static_dir = os.path.join(os.path.dirname(__file__), 'static')
+static_urls = {}
+
+
+def static_url(path):
+    # static files are served with a long expiration (see app.yaml),
+    # so their URLs carry a fingerprint of the content
+    if path not in static_urls:
+        try:
+            with open(os.path.join(static_dir, path), 'rb') as f:
+                fingerprint = hashlib.md5(f.read()).hexdigest()[:10]
+        except IOError:
+            fingerprint = ""
+        static_urls[path] = "/static/%s?v=%s" % (path, fingerprint)
+    return static_urls[path]
+
+jinja_env.globals["static_url"] = static_url
 
 # Rendering handler and rendering methods
 
 
+class StageTimer(object):
+    # logs how long each stage of a request took, to show which
+    # lookup the request was waiting on
+    def __init__(self, name):
+        self.name = name
+        self.last = time.time()
+        self.stages = []
+
+    def mark(self, stage):
+        now = time.time()
+        self.stages.append((stage, (now - self.last) * 1000))
+        self.last = now
+
+    def log(self):
+        logging.info("%s: %s (%.1fms total)", self.name,
+                     ", ".join("%s %.1fms" % s for s in self.stages),
+                     sum(ms for _, ms in self.stages))
+
+
 class BaseHandler(webapp2.RequestHandler):
+    def dispatch(self):
+        profiling.set_handler(self.__class__.__name__)
+        if self.request.method == "POST" and self.throttled():
+            # answered before any datastore work
+            self.response.set_status(429, "Too Many Requests")
+            self.write("Too many requests. Please slow down.")
+            return
+        super(BaseHandler, self).dispatch()
+
+    def throttled(self):
+        # checks the token buckets configured for this handler in the
+        # app's "rate_limits", one per user and one per IP. The user
+        # bucket is always keyed by the session token, which every
+        # instance sees the same way without a lookup
+        limits = self.app.config.get("rate_limits", {}) \
+                                .get(self.__class__.__name__)
+        if not limits:
+            return False
+        keys = {"ip": self.request.remote_addr,
+                "user": self.get_cookie("session")}
+        for bucket, (rate, burst) in sorted(limits.items()):
+            key = keys.get(bucket)
+            if key and not ratelimit.take(
+                    "%s:%s:%s" % (self.__class__.__name__, bucket, key),
+                    rate, burst):
+                return True
+        return False
+
     def write(self, output):
         self.response.write(output)
 
     def render_str(self, template, **kwargs):
+        start = time.time()
         # fetch template with the {{variables}}
         t = jinja_env.get_template(template)
         # fill in variables according to kwargs
-        return t.render(**kwargs)
+        output = t.render(**kwargs)
+        profiling.record_render((time.time() - start) * 1000)
+        return output
 
     def render(self, template, **kwargs):
         # display template with variables filled in
         self.write(self.render_str(template, **kwargs))
 
     def render_front(self, form=False, title="", blog="", error="",
-                     blogs=""):
-        blogs = db.GqlQuery("SELECT * FROM Blog "
-                            "ORDER BY date DESC LIMIT 10")
+                     cursor="", size=PAGE_SIZE):
         username = self.get_current_user()
 
+        if cursor or size != PAGE_SIZE:
+            page = self.page_of_posts(cursor, size)
+        else:
+            # only the first page is shared by everyone, so only it is
+            # worth caching
+            page = cache.fragment("front:%d" % cache.front_generation(),
+                                  lambda: self.page_of_posts("", PAGE_SIZE))
         self.render("main.html",
                     form=form,
                     username=username,
                     title=title,
                     blog=blog,
                     error=error,
-                    blogs=blogs)
+                    posts_html=self.render_str("posts.html",
+                                               page_html=page["html"]))
+
+    def fetch_page(self, query, cursor, size):
+        # a page costs the same however deep the cursor points, unlike
+        # an offset, which the datastore has to skip through. Returns
+        # the page and the cursor of the next one, if there may be one
+        if cursor:
+            query.with_cursor(cursor)
+        entities = query.fetch(size)
+        if len(entities) == size:
+            return entities, query.cursor()
+        return entities, None
+
+    def page_of_posts(self, cursor, size, patch=None):
+        blogs, next_cursor = self.fetch_page(
+            models.Blog.all().order("-date"), cursor, size)
+        if patch:
+            blogs = patch(blogs)
+        models.prefetch_refs(blogs, models.Blog.author)
+        next_url = page_url = None
+        if next_cursor:
+            params = "cursor=%s&size=%d" % (next_cursor, size)
+            next_url = "/blog?" + params
+            page_url = "/blog/page.json?" + params
+        return {"html": self.render_str("post_list.html", blogs=blogs,
+                                        next_url=next_url,
+                                        page_url=page_url),
+                "next": next_cursor}
+
+    def refresh_front(self, post, new=False, deleted=False):
+        # moves the index to a new generation after post was written
+        # and caches its first page right away. The query behind the
+        # page is eventually consistent, so just after the write it
+        # can still miss a new post, list a deleted one or return an
+        # edited one's old text; post is patched in over the results.
+        # A new post can make the page one longer until the next write
+        def patch(blogs):
+            patched = [b for b in blogs if b.key() != post.key()]
+            if new:
+                patched.insert(0, post)
+            elif not deleted and len(patched) < len(blogs):
+                patched.append(post)
+            return sorted(patched, key=lambda b: b.date, reverse=True)
+
+        page = self.page_of_posts("", PAGE_SIZE, patch)
+        generation = cache.bump_front()
+        if generation:
+            cache.set_fragment("front:%d" % generation, page)
+
+    def page_params(self):
+        cursor = self.request.get("cursor")
+        try:
+            size = int(self.request.get("size", PAGE_SIZE))
+        except ValueError:
+            size = PAGE_SIZE
+        return cursor, max(1, min(size, MAX_PAGE_SIZE))
+
+    def page_of_comments(self, post, cursor):
+        # a page of the threads on a post, newest first. Their replies
+        # are only loaded when asked for (see page_of_replies)
+        comments, next_cursor = self.fetch_page(
+            models.Comment.top_level(post.key()), cursor, COMMENT_PAGE_SIZE)
+        models.prefetch_refs(comments, models.Comment.author)
+        post_id = post.key().id()
+        next_url = page_url = None
+        if next_cursor:
+            next_url = "/blog/%d?cursor=%s" % (post_id, next_cursor)
+            page_url = "/blog/%d/comments.json?cursor=%s" % (post_id,
+                                                              next_cursor)
+        return {"comments_html": self.render_str("comments.html",
+                                                 post_id=post_id,
+                                                 comments=comments,
+                                                 threads=True,
+                                                 next_url=next_url,
+                                                 page_url=page_url),
+                "authors": dict((c.key().id(), c.author.username)
+                                for c in comments),
+                "next": next_cursor}
+
+    def page_of_replies(self, comment, cursor):
+        # a page of the replies under comment, at any depth, in reading
+        # order: one range scan over their paths
+        replies, next_cursor = self.fetch_page(
+            models.Comment.subtree(comment), cursor, REPLY_PAGE_SIZE)
+        models.prefetch_refs(replies, models.Comment.author)
+        post_id = comment.key().parent().id()
+        page_url = None
+        if next_cursor:
+            page_url = "/blog/%d/comment/%d/replies?cursor=%s" % (
+                post_id, comment.key().id(), next_cursor)
+        return {"comments_html": self.render_str("comments.html",
+                                                 post_id=post_id,
+                                                 comments=replies,
+                                                 base_depth=comment.depth,
+                                                 page_url=page_url),
+                "authors": dict((c.key().id(), c.author.username)
+                                for c in replies),
+                "next": next_cursor}
+
+    def render_show(self, username, post_id, error, comment=None,
+                    etag=None, version=None, cursor=None, reply_to=None):
+        # the lookups that don't depend on each other are all started
+        # before any of them is waited on
+        timer = StageTimer("render_show")
+        post_key = db.Key.from_path("Blog", int(post_id))
+        post_rpc = db.get_async(post_key)
+        votes_rpc = counters.get_count_async(post_id)
+        vote_rpc = None
+        if username:
+            vote_rpc = db.get_async(
+                models.Like.key_for(post_key, self.get_current_user_key()))
+
+        post = post_rpc.get_result()
+        timer.mark("post")
+        if not post:
+            self.render("error.html")
+            return
+        if etag:
+            last_modified = max(post.last_edited or post.date,
+                                cache.version_time(version))
+            if self.not_modified(etag, last_modified):
+                return
+        author_rpc = db.get_async(
+            models.Blog.author.get_value_for_datastore(post))
+        fragments = self.permalink_fragments(post, cursor)
+        timer.mark("fragments")
+        models.Blog.author.__set__(post, author_rpc.get_result())
+        timer.mark("author")
+        votes = votes_rpc.get_result()
+        timer.mark("votes")
+        vote = vote_rpc.get_result() if vote_rpc else None
+        timer.mark("user vote")
 
-    def render_show(self, username, post, error, comment=None):
-        comments = models.Comment.by_post(post.key().id())
-        votes = models.Like.count_likes(post.key().id())
-        current_user = models.User.get_by("username", username)
         has_voted_up = ""
         has_voted_down = ""
-
-        if models.Like.vote_of_post(post, current_user):
-            has_voted_up = "voted"
-        elif models.Like.vote_of_post(post, current_user) is False:
-            has_voted_down = "voted"
-
-        if username == post.author.username:
-            self.render("permalink.html", username=username, post=post,
-                        comments=comments, comment=comment, error=error,
-                        user_is_author=True, votes=votes,
-                        has_voted_up="",
-                        has_voted_down="")
+        user_is_author = username == post.author.username
+        if vote and not user_is_author:
+            if vote.status:
+                has_voted_up = "voted"
+            else:
+                has_voted_down = "voted"
+
+        self.render_permalink(username=username, post=post,
+                              fragments=fragments, comment=comment,
+                              reply_to=reply_to, error=error,
+                              user_is_author=user_is_author,
+                              votes=votes, has_voted_up=has_voted_up,
+                              has_voted_down=has_voted_down)
+        timer.mark("render")
+        timer.log()
+
+    def render_permalink(self, username, post, fragments=None, **kwargs):
+        # the post and its comments come from the fragment cache; the
+        # parts that depend on the viewer are filled in around them
+        if fragments is None:
+            fragments = self.permalink_fragments(post)
+        comments_html = self.stitch_comments(fragments, post.key().id(),
+                                             username)
+        self.render("permalink.html", username=username, post=post,
+                    post_html=fragments["post_html"],
+                    comments_html=comments_html, **kwargs)
+
+    def permalink_fragments(self, post, cursor=None):
+        post_id = post.key().id()
+
+        def render_fragments():
+            fragments = self.page_of_comments(post, None)
+            fragments["post_html"] = self.render_str("post.html", post=post)
+            return fragments
+
+        key = "post:%d:%d" % (post_id, cache.post_version(post_id))
+        fragments = cache.fragment(key, render_fragments)
+        if cursor:
+            # only the first page of comments is cached, as on the index
+            fragments = dict(fragments,
+                             **self.page_of_comments(post, cursor))
+        return fragments
+
+    def stitch_comments(self, fragments, post_id, username):
+        # puts the edit/delete links on the viewer's own comments
+        authors = fragments["authors"]
+
+        def modify_links(match):
+            comment_id = int(match.group(1))
+            if authors.get(comment_id) != username:
+                return ""
+            return self.render_str("comment_modify.html", post_id=post_id,
+                                   comment_id=comment_id)
+
+        return COMMENT_MODIFY_RE.sub(modify_links,
+                                     fragments["comments_html"])
+
+    def not_modified(self, etag, last_modified=None):
+        # sets the validators of a per-user page and answers 304 if the
+        # client's copy is still current, before anything is rendered
+        etag = '"%s"' % hashlib.sha1(
+            "|".join([os.environ.get("CURRENT_VERSION_ID", "")] +
+                     [unicode(part) for part in etag]).encode("utf-8")
+        ).hexdigest()
+        self.response.headers["ETag"] = etag
+        self.response.headers["Cache-Control"] = \
+            "private, max-age=0, must-revalidate"
+        self.response.headers["Vary"] = "Cookie"
+        if last_modified:
+            self.response.headers["Last-Modified"] = email.utils.formatdate(
+                calendar.timegm(last_modified.utctimetuple()), usegmt=True)
+
+        if_none_match = self.request.headers.get("If-None-Match")
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_none_match:
+            fresh = etag in [tag.strip() for tag in if_none_match.split(",")]
+        elif if_modified_since and last_modified:
+            since = email.utils.parsedate(if_modified_since)
+            fresh = since is not None and \
+                calendar.timegm(last_modified.utctimetuple()) <= \
+                calendar.timegm(since)
         else:
-            self.render("permalink.html", username=username, post=post,
-                        comments=comments, comment=comment, error=error,
-                        user_is_author=False, votes=votes,
-                        has_voted_up=has_voted_up,
-                        has_voted_down=has_voted_down)
+            fresh = False
+        if fresh:
+            self.response.set_status(304)
+        return fresh
+
+    def cache_publicly(self):
+        # for pages that are the same for every anonymous visitor
+        self.response.headers["Cache-Control"] = "public, max-age=3600"
+        self.response.headers["Vary"] = "Cookie"
+
+    def is_comment_author(self, comment):
+        user_key = self.get_current_user_key()
+        return bool(comment and user_key and
+                    models.Comment.author.get_value_for_datastore(comment)
+                    == user_key)
 
     def redirect_if_not_logged_in(self):
         if not self.get_current_user():
@@ -83,36 +393,108 @@ class BaseHandler(webapp2.RequestHandler):
         raw_cookies = self.request.headers.get("Cookie")
         if raw_cookies:
             for cookie in raw_cookies.split(";"):
-                cookie = cookie.split("=")
+                cookie = cookie.strip().split("=", 1)
                 if cookie[0] == name:
                     return cookie[1]
         return None
 
     def get_current_user(self):
-        cookie = self.get_cookie("name")
-        if cookie:
-            username = cookie.split("|")[0]
-            cookie_hash = cookie.split("|")[1]
-            user = models.User.get_by("username", username)
-            if user:
-                password_digest = user.password_digest.split("|")[1]
-                if username and (cookie_hash == password_digest):
-                    return username
-        self.response.delete_cookie("name")
+        # the session is resolved once per request and then memoized
+        if not hasattr(self, "_session"):
+            self._session = self.lookup_session()
+        if self._session:
+            return self._session[1]
         return None
 
+    def get_current_user_key(self):
+        if self.get_current_user():
+            return self._session[0]
+        return None
+
+    def get_current_user_entity(self):
+        if not hasattr(self, "_current_user"):
+            self._current_user = None
+            if self.get_current_user():
+                self._current_user = models.User.get(
+                    self.get_current_user_key())
+        return self._current_user
+
+    def lookup_session(self):
+        # the password hash never runs here: the cookie holds a random
+        # token that is looked up by key, and hot tokens are served
+        # from the in-process session cache
+        token = self.get_cookie("session")
+        if token:
+            session = sessions.lookup(token)
+            if session:
+                return session
+            session = models.Session.get_by_key_name(token)
+            if session:
+                user_key = models.Session.user.get_value_for_datastore(
+                    session)
+                sessions.remember(token, user_key, session.username)
+                return (user_key, session.username)
+            self.response.delete_cookie("session")
+        return None
+
+    def start_session(self, user):
+        token = signup_helper.new_session_token()
+        models.Session(key_name=token, user=user,
+                       username=user.username).put()
+        sessions.remember(token, user.key(), user.username)
+        self.response.headers.add_header('Set-Cookie',
+                                         'session={0};Path=/;HttpOnly'
+                                         .format(token))
+
+    def end_session(self):
+        token = self.get_cookie("session")
+        if token:
+            # other instances may have the token cached (see sessions.py)
+            sessions.revoke(token)
+            db.delete(db.Key.from_path("Session", token))
+        self.response.headers.add_header('Set-Cookie',
+                                         'session=;Path=/')
+
 
 # handling routes
 
 class Greet(BaseHandler):
     def get(self):
+        self.cache_publicly()
         self.render("greet.html")
 
 
 class MainPage(BaseHandler):
     def get(self):
-        self.redirect_if_not_logged_in()
-        self.render_front()
+        username = self.get_current_user()
+        if not username:
+            self.redirect('/blog/login')
+            return
+        cursor, size = self.page_params()
+        generation = cache.front_generation()
+        if self.not_modified(("front", generation, cursor, size, username),
+                             cache.version_time(generation)):
+            return
+        try:
+            self.render_front(cursor=cursor, size=size)
+        except (db.BadRequestError, db.BadValueError):
+            self.render("error.html")
+
+
+class PostsPage(BaseHandler):
+    # the next page of the index as JSON, for infinite scrolling
+    def get(self):
+        if not self.get_current_user():
+            self.redirect('/blog/login')
+            return
+        cursor, size = self.page_params()
+        try:
+            page = self.page_of_posts(cursor, size)
+        except (db.BadRequestError, db.BadValueError):
+            self.error(400)
+            return
+        self.response.headers["Content-Type"] = "application/json"
+        self.write(json.dumps(page))
 
 
 class NewPost(BaseHandler):
@@ -128,10 +510,14 @@ class NewPost(BaseHandler):
         title = self.request.get("subject")
         blog = self.request.get("content")
         username = self.get_current_user()
-        user = models.User.get_by("username", username)
+        user = self.get_current_user_entity()
         if title and blog and username:
             b = models.Blog(title=title, blog=blog, author=user)
+            b.render_body()
             b.put()
+            models.User.adjust_stats(user.key(), posts=1)
+            search.index_post(b)
+            self.refresh_front(b, new=True)
             self.redirect("/blog/%s" % b.key().id())
         else:
             error = "We need both a title and a blog in order to publish this entry."
@@ -140,24 +526,165 @@ class NewPost(BaseHandler):
                         blog=blog, error=error, submit="Publish")
 
 
+class SearchPosts(BaseHandler):
+    def get(self):
+        username = self.get_current_user()
+        if not username:
+            self.redirect('/blog/login')
+            return
+        query = self.request.get("q")
+        posts = search.search(query) if query else []
+        models.prefetch_refs(posts, models.Blog.author)
+        page_html = self.render_str("post_list.html", blogs=posts)
+        if query and not posts:
+            page_html = self.render_str("no_results.html", query=query)
+        self.render("main.html",
+                    username=username,
+                    query=query,
+                    posts_html=self.render_str("posts.html",
+                                               page_html=page_html))
+
+
+class RankedPosts(BaseHandler):
+    # /blog/top (by net votes) and /blog/trending (by time-decayed
+    # hotness), each one ordered query on an indexed property
+    ORDERS = {"top": "-score", "trending": "-hotness"}
+
+    def get(self, feed):
+        username = self.get_current_user()
+        if not username:
+            self.redirect('/blog/login')
+            return
+        cursor, size = self.page_params()
+        try:
+            blogs, next_cursor = self.fetch_page(
+                models.Blog.all().order(self.ORDERS[feed]), cursor, size)
+        except (db.BadRequestError, db.BadValueError):
+            self.render("error.html")
+            return
+        models.prefetch_refs(blogs, models.Blog.author)
+        next_url = None
+        if next_cursor:
+            next_url = "/blog/%s?cursor=%s&size=%d" % (feed, next_cursor,
+                                                       size)
+        page_html = self.render_str("post_list.html", blogs=blogs,
+                                    next_url=next_url)
+        self.render("main.html", username=username,
+                    posts_html=self.render_str("posts.html",
+                                               page_html=page_html))
+
+
+class UserProfile(BaseHandler):
+    # an author's stats and their posts and comments, newest first,
+    # each list paged with its own cursor
+    def get(self, name):
+        username = self.get_current_user()
+        if not username:
+            self.redirect('/blog/login')
+            return
+        user = models.User.by_username(name)
+        if not user:
+            self.render("error.html")
+            return
+
+        try:
+            posts, posts_cursor = self.fetch_page(
+                models.Blog.by_author(user), self.request.get("posts"),
+                PAGE_SIZE)
+            comments, comments_cursor = self.fetch_page(
+                models.Comment.by_author(user), self.request.get("comments"),
+                PAGE_SIZE)
+        except (db.BadRequestError, db.BadValueError):
+            self.render("error.html")
+            return
+        for post in posts:
+            models.Blog.author.__set__(post, user)
+
+        next_url = None
+        if posts_cursor:
+            next_url = "/blog/user/%s?posts=%s" % (name, posts_cursor)
+        self.render("profile.html", username=username, user=user,
+                    score=counters.get_user_score(user.key()),
+                    posts_html=self.render_str("post_list.html", blogs=posts,
+                                               next_url=next_url),
+                    comments=comments, comments_cursor=comments_cursor)
+
+
 class ShowPost(BaseHandler):
     def get(self, number):
-        self.redirect_if_not_logged_in()
-        post = models.Blog.get_by_id(int(number))
-        if not post:
-            self.render("error.html")
+        error = self.request.get("error")
+        username = self.get_current_user()
+        if not username:
+            self.redirect('/blog/login')
+            return
+
+        if error:
+            error = "Cannot submit empty comment."
         else:
-            error = self.request.get("error")
-            username = self.get_current_user()
+            error = ""
+        cursor = self.request.get("cursor")
+        reply_id = self.request.get("reply_to")
+
+        # the post version changes with every edit, comment and vote
+        version = cache.post_version(number)
+        etag = ("post", number, version, username, error, cursor, reply_id)
+        if self.not_modified(etag):
+            return
+        reply_to = None
+        if reply_id.isdigit():
+            reply_to = models.Comment.get_for_post(number, reply_id)
+        try:
+            self.render_show(username=username,
+                             post_id=number,
+                             error=error,
+                             etag=etag,
+                             version=version,
+                             cursor=cursor,
+                             reply_to=reply_to)
+        except (db.BadRequestError, db.BadValueError):
+            self.render("error.html")
 
-            if error:
-                error = "Cannot submit empty comment."
-            else:
-                error = ""
 
-            self.render_show(username=username,
-                             post=post,
-                             error=error)
+class CommentsPage(BaseHandler):
+    # the next page of a post's threads as JSON, see comments.js
+    def get(self, number):
+        if not self.get_current_user():
+            self.redirect('/blog/login')
+            return
+        post = models.Blog.get_by_id(int(number))
+        if not post:
+            self.error(404)
+            return
+        try:
+            page = self.page_of_comments(post, self.request.get("cursor"))
+        except (db.BadRequestError, db.BadValueError):
+            self.error(400)
+            return
+        self.write_comments(page, post.key().id())
+
+    def write_comments(self, page, post_id):
+        html = self.stitch_comments(page, post_id, self.get_current_user())
+        self.response.headers["Content-Type"] = "application/json"
+        self.write(json.dumps({"html": html, "next": page["next"]}))
+
+
+class CommentReplies(CommentsPage):
+    # the replies under a comment as JSON, loaded when the reader
+    # opens its thread, see comments.js
+    def get(self, post_id, comment_id):
+        if not self.get_current_user():
+            self.redirect('/blog/login')
+            return
+        comment = models.Comment.get_for_post(post_id, comment_id)
+        if not comment or not comment.path:
+            self.error(404)
+            return
+        try:
+            page = self.page_of_replies(comment, self.request.get("cursor"))
+        except (db.BadRequestError, db.BadValueError):
+            self.error(400)
+            return
+        self.write_comments(page, int(post_id))
 
 
 class EditPost(BaseHandler):
@@ -187,9 +714,10 @@ class EditPost(BaseHandler):
         if not post or post.author.username != username:
             self.render("error.html")
         elif title and blog:
-            post.title = title
-            post.blog = blog
-            post.put()
+            post = models.Blog.edit(number, title, blog)
+            search.index_post(post)
+            cache.bump_post(number)
+            self.refresh_front(post)
             self.redirect("/blog/%s" % number)
         else:
             error = "We need both a title and a blog in order to update this entry."
@@ -210,8 +738,8 @@ class DeletePost(BaseHandler):
         if not post or post.author.username != username:
             self.render("error.html")
         else:
-            self.render("permalink.html", username=username, post=post,
-                        user_is_author=True, modal=True)
+            self.render_permalink(username=username, post=post,
+                                  user_is_author=True, modal=True)
 
     def post(self, number):
         self.redirect_if_not_logged_in()
@@ -221,111 +749,131 @@ class DeletePost(BaseHandler):
         if not post or post.author.username != username:
             self.render("error.html")
         else:
-            post.delete()
-            comments = post.comments
-            likes = post.likes
-            username = self.get_current_user()
-            for comment in comments:
-                comment.delete()
-            for like in likes:
-                like.delete()
-            self.render("permalink.html", username=username, post=post,
-                        user_is_author=False)
+            # deleting the post first takes it off every listing at
+            # once; its comments, votes and counters go in batches
+            # after it. The task that deletes them is queued in the
+            # same transaction, so they can't be left behind if this
+            # request fails after the post is gone
+            post_key = post.key()
+            score = counters.get_count(post_key.id())
+
+            def txn():
+                post.delete()
+                taskqueue.add(url="/tasks/cascade_delete",
+                              params={"post": str(post_key)},
+                              transactional=True)
+
+            db.run_in_transaction(txn)
+            author_key = models.Blog.author.get_value_for_datastore(post)
+            models.User.adjust_stats(author_key, posts=-1)
+            counters.adjust_user_score(author_key, -score)
+            cache.bump_post(number)
+            self.refresh_front(post, deleted=True)
+            self.redirect("/blog")
 
 
 class NewVote(BaseHandler):
     def post(self, number, voted):
-        self.redirect_if_not_logged_in()
-        current_user = models.User.get_by("username",
-                                          self.get_current_user())
+        if not self.get_current_user():
+            self.redirect('/blog/login')
+            return
+        current_user = self.get_current_user_entity()
         post = models.Blog.get_by_id(int(number))
         if not post:
             self.render("error.html")
+            return
 
-        comments = post.comments
-        votes = models.Like.count_likes(post.key().id())
+        votes = counters.get_count(post.key().id())
         vote_error = ""
         has_voted_up = ""
         has_voted_down = ""
 
         if post.author.username == current_user.username:
             vote_error = "You cannot vote on your own post."
-            self.render("permalink.html",
-                        username=current_user.username, post=post,
-                        comments=comments, vote_error=vote_error,
-                        user_is_author=True, votes=votes,
-                        has_voted_up=has_voted_up,
-                        has_voted_down=has_voted_down)
-        else:
-            if voted == "like":
-                if models.Like.vote_of_post(post, current_user):
-                    vote_error = "Already voted up. Cannot vote twice."
-                    has_voted_up = "voted"
-                elif models.Like.vote_of_post(post,
-                                                current_user) is False:
-                    vote = models.Like.gql("WHERE post=:1 AND user=:2",
-                                            post, current_user).get()
-                    vote.delete()
-                    time.sleep(0.2)
-                    self.redirect("/blog/%s" % post.key().id())
-                else:
-                    like = models.Like(user=current_user,
-                                       post=post,
-                                       status=True)
-                    like.put()
-                    time.sleep(0.2)
-                    has_voted_up = "voted"
-                    self.redirect("/blog/%s" % post.key().id())
-
-            elif voted == "dislike":
-                if models.Like.vote_of_post(post, current_user):
-                    vote = models.Like.gql("WHERE post=:1 AND user=:2",
-                                            post,
-                                            current_user).get()
-                    vote.delete()
-                    time.sleep(0.2)
-                    self.redirect("/blog/%s" % post.key().id())
-                elif models.Like.vote_of_post(post, current_user) is False:
-                    vote_error = "Already voted down. Cannot vote twice."
-                    has_voted_down = "voted"
-                else:
-                    like = models.Like(user=current_user, post=post,
-                                        status=False)
-                    like.put()
-                    time.sleep(0.2)
-                    has_voted_down = "voted"
-                    self.redirect("/blog/%s" % post.key().id())
-
-            self.render("permalink.html", username=current_user.username,
-                        post=post, comments=comments,
-                        vote_error=vote_error, user_is_author=False,
-                        votes=votes, has_voted_up=has_voted_up,
-                        has_voted_down=has_voted_down)
+            self.render_permalink(username=current_user.username,
+                                  post=post, vote_error=vote_error,
+                                  user_is_author=True, votes=votes,
+                                  has_voted_up=has_voted_up,
+                                  has_voted_down=has_voted_down)
+            return
+
+        # a vote redirects back to the post; only a refused one renders
+        # it here, with the error
+        current_vote = models.Like.vote_of_post(post, current_user)
+        if voted == "like":
+            if current_vote:
+                vote_error = "Already voted up. Cannot vote twice."
+                has_voted_up = "voted"
+            else:
+                # a like cancels a dislike
+                counters.cast_vote(post, current_user,
+                                   None if current_vote is False else True)
+                cache.bump_post(number)
+                self.redirect("/blog/%s" % post.key().id())
+                return
+
+        elif voted == "dislike":
+            if current_vote is False:
+                vote_error = "Already voted down. Cannot vote twice."
+                has_voted_down = "voted"
+            else:
+                # a dislike cancels a like
+                counters.cast_vote(post, current_user,
+                                   None if current_vote else False)
+                cache.bump_post(number)
+                self.redirect("/blog/%s" % post.key().id())
+                return
+
+        self.render_permalink(username=current_user.username,
+                              post=post, vote_error=vote_error,
+                              user_is_author=False, votes=votes,
+                              has_voted_up=has_voted_up,
+                              has_voted_down=has_voted_down)
 
 
 class NewComment(BaseHandler):
     def post(self, number):
         self.redirect_if_not_logged_in()
         body = self.request.get("content")
-        author = models.User.gql("WHERE username=:1",
-                                self.get_current_user()).get()
+        author = self.get_current_user_entity()
         post = models.Blog.get_by_id(int(number))
+        reply_id = self.request.get("reply_to")
+        reply_to = None
+        if reply_id.isdigit():
+            reply_to = models.Comment.get_for_post(number, reply_id)
         if body == "":
-            self.redirect("/blog/%s?error=True" % number)
+            if reply_to:
+                self.redirect("/blog/%s?error=True&reply_to=%s#comment-form"
+                              % (number, reply_id))
+            else:
+                self.redirect("/blog/%s?error=True" % number)
         elif body and author and post:
-            c = models.Comment(body=body, author=author, post=post)
-            c.put()
-            time.sleep(0.1)
+            if reply_to and not reply_to.path:
+                # written before threading; migrations.thread_comments
+                # hasn't got to it yet
+                reply_to = None
+            c = models.Comment.new(post, author, body, reply_to)
+            parent_key = models.Comment.reply_to.get_value_for_datastore(c)
+
+            def txn():
+                c.put()
+                if parent_key:
+                    models.Comment.adjust_replies(parent_key, 1)
+                ranking.adjust(post.key(), comments=1)
+
+            db.run_in_transaction(txn)
+            models.User.adjust_stats(author.key(), comments=1)
+            search.index_comment(c)
+            cache.bump_post(number)
             self.redirect("/blog/%s" % number)
 
 
 class EditComment(BaseHandler):
     def get(self, post_id, comment_id):
         self.redirect_if_not_logged_in()
-        post = models.Blog.get_by_id(int(post_id))
-        comment = models.Comment.get_by_id(int(comment_id))
+        comment = models.Comment.get_for_post(post_id, comment_id)
 
-        if not post or not comment:
+        if not self.is_comment_author(comment):
             self.render("error.html")
         else:
             username = self.get_current_user()
@@ -336,29 +884,57 @@ class EditComment(BaseHandler):
             else:
                 error = ""
 
-            self.render_show(username=username, post=post,
+            self.render_show(username=username, post_id=post_id,
                              comment=comment, error=error)
 
     def post(self, post_id, comment_id):
         self.redirect_if_not_logged_in()
-        comment = models.Comment.get_by_id(int(comment_id))
-        if not comment:
+        comment = models.Comment.get_for_post(post_id, comment_id)
+        if not self.is_comment_author(comment):
             self.render("error.html")
         else:
             body = self.request.get("content")
             comment.body = body
+            comment.render_body()
             comment.put()
-            time.sleep(0.2)
+            search.index_comment(comment)
+            cache.bump_post(post_id)
             self.redirect("/blog/%s" % post_id)
 
 
 class DeleteComment(BaseHandler):
     def post(self, post_id, comment_id):
         self.redirect_if_not_logged_in()
-        comment = models.Comment.get_by_id(int(comment_id))
-        if comment:
-            comment.delete()
-            time.sleep(0.2)
+        comment = models.Comment.get_for_post(post_id, comment_id)
+        if self.is_comment_author(comment):
+            # the replies under a comment go with it
+            replies = []
+            if comment.path:
+                replies = models.Comment.subtree(comment).fetch(None)
+            parent_key = models.Comment.reply_to.get_value_for_datastore(
+                comment)
+
+            def txn():
+                comment.delete()
+                if parent_key:
+                    models.Comment.adjust_replies(parent_key, -1)
+                ranking.adjust(comment.key().parent(),
+                               comments=-1 - len(replies))
+
+            db.run_in_transaction(txn)
+            # a whole thread may be too big for one batch delete
+            for start in range(0, len(replies), 500):
+                db.delete(replies[start:start + 500])
+
+            deleted = {}
+            for c in [comment] + replies:
+                author_key = models.Comment.author.get_value_for_datastore(c)
+                deleted[author_key] = deleted.get(author_key, 0) + 1
+            for author_key, count in deleted.items():
+                models.User.adjust_stats(author_key, comments=-count)
+            search.unindex_comment(post_id, comment_id,
+                                   *[c.key().id() for c in replies])
+            cache.bump_post(post_id)
             self.redirect("/blog/%s" % post_id)
         else:
             self.render("error.html")
@@ -369,6 +945,7 @@ class SignUp(BaseHandler):
         if self.get_current_user():
             self.redirect('/blog')
         else:
+            self.cache_publicly()
             self.render('signup_form.html')
 
     def post(self):
@@ -385,7 +962,7 @@ class SignUp(BaseHandler):
         if not signup_helper.validate_username(username):
             username_error = "Username must have 3-20 alphanumeric characters"
             no_errors = False
-        if models.User.gql("WHERE username=:1", username).get():
+        elif models.User.by_username(username):
             username_error = "Username has already been taken."
             no_errors = False
         if not signup_helper.validate_password(password):
@@ -399,22 +976,20 @@ class SignUp(BaseHandler):
             no_errors = False
 
         if no_errors:
-            password_digest = signup_helper.secure_str(username, password)
-            user = models.User(username=username,
-                                password_digest=password_digest)
-            user.put()
-            cookie = signup_helper.secure_str(username, password)
-            self.response.headers.add_header('Set-Cookie',
-                                             'name={0};Path=/'
-                                             .format(cookie))
-            time.sleep(0.2)
-            self.redirect('/blog')
-        else:
-            self.render('signup_form.html', username=username,
-                        email=email, username_error=username_error,
-                        password_error=password_error,
-                        verify_error=verify_error,
-                        email_error=email_error)
+            password_digest = signup_helper.hash_password(password)
+            user = models.User.create(username, password_digest)
+            if user:
+                self.start_session(user)
+                self.redirect('/blog')
+                return
+            # someone else claimed the name since the check above
+            username_error = "Username has already been taken."
+
+        self.render('signup_form.html', username=username,
+                    email=email, username_error=username_error,
+                    password_error=password_error,
+                    verify_error=verify_error,
+                    email_error=email_error)
 
 
 class Login(BaseHandler):
@@ -422,19 +997,20 @@ class Login(BaseHandler):
         if self.get_current_user():
             self.redirect('/blog')
         else:
+            self.cache_publicly()
             self.render('login.html')
 
     def post(self):
         username = self.request.get("username")
         password = self.request.get("password")
-        user = models.User.gql("WHERE username=:1", username).get()
-        cookie = signup_helper.secure_str(username, password)
+        user = models.User.by_username(username)
         if user and signup_helper.validate_credentials(username,
                                                   password,
                                                   user.password_digest):
-            self.response.headers.add_header('Set-Cookie',
-                                             'name={0};Path=/'
-                                             .format(cookie))
+            if signup_helper.needs_upgrade(user.password_digest):
+                user.password_digest = signup_helper.hash_password(password)
+                user.put()
+            self.start_session(user)
             self.redirect('/blog')
         else:
             error = "Invalid Login"
@@ -443,21 +1019,234 @@ class Login(BaseHandler):
 
 class Logout(BaseHandler):
     def post(self):
-        self.response.headers.add_header('Set-Cookie',
-                                         'name=;Path=/')
+        self.end_session()
         self.redirect('/blog/login')
 
+# admin only pages (see app.yaml)
+
+class Stats(BaseHandler):
+    # request timing percentiles per handler, see profiling.py
+    def get(self):
+        self.response.headers["Content-Type"] = "application/json"
+        self.write(json.dumps(profiling.summary(), indent=2,
+                              sort_keys=True))
+
+
+class CacheStats(BaseHandler):
+    def get(self):
+        self.response.headers["Content-Type"] = "application/json"
+        self.write(json.dumps(cache.stats()))
+
+
+# background tasks, admin only (see app.yaml)
+
+class ReconcileVotes(BaseHandler):
+    # checks the vote counters of every post against the Like table
+    # and corrects the ones that are off, a batch of posts per task
+    BATCH_SIZE = 50
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        query = models.Blog.all(keys_only=True)
+        cursor = self.request.get("cursor")
+        if cursor:
+            query.with_cursor(cursor)
+        post_keys = query.fetch(self.BATCH_SIZE)
+        for post_key in post_keys:
+            counters.reconcile(post_key.id())
+        if len(post_keys) == self.BATCH_SIZE:
+            taskqueue.add(url="/tasks/reconcile_votes",
+                          params={"cursor": query.cursor()})
+
+
+class CascadeDelete(BaseHandler):
+    # deletes what is left under a deleted post, then its vote
+    # counters. Each run starts over from whatever remains, so a
+    # failed task can simply be retried
+    RUNS_PER_TASK = 10
+
+    def post(self):
+        post_key = db.Key(self.request.get("post"))
+        for _ in range(self.RUNS_PER_TASK):
+            if models.delete_descendants(post_key):
+                counters.delete_counts(post_key.id())
+                return
+        taskqueue.add(url="/tasks/cascade_delete",
+                      params={"post": str(post_key)})
+
+
+class ReconcileUserStats(BaseHandler):
+    # recounts every user's profile stats from the datastore, a batch
+    # of users per task. Catches up with comments removed by a post's
+    # cascade delete and with score shards that missed an update, and
+    # fills in the stats of older accounts
+    BATCH_SIZE = 20
+
+    def get(self):
+        self.post()
+
+    def post(self):
+        query = models.User.all()
+        cursor = self.request.get("cursor")
+        if cursor:
+            query.with_cursor(cursor)
+        users = query.fetch(self.BATCH_SIZE)
+        for user in users:
+            post_ids = [key.id() for key in
+                        models.Blog.all(keys_only=True)
+                                   .filter("author =", user).run()]
+            comment_count = models.Comment.all(keys_only=True) \
+                                          .filter("author =", user) \
+                                          .count(None)
+            models.User.set_stats(user.key(), len(post_ids), comment_count)
+            counters.set_user_score(user.key(),
+                                    sum(counters.get_count(post_id)
+                                        for post_id in post_ids))
+        if len(users) == self.BATCH_SIZE:
+            taskqueue.add(url="/tasks/reconcile_user_stats",
+                          params={"cursor": query.cursor()})
+
+
+class RedecayRanking(BaseHandler):
+    def get(self):
+        ranking.redecay()
+
+
+class RebuildRanking(BaseHandler):
+    # recounts the ranking of every post, a batch per task. Run it once
+    # to rank posts written before the feeds existed
+    def get(self):
+        self.post()
+
+    def post(self):
+        cursor = ranking.rebuild(self.request.get("cursor"))
+        if cursor:
+            taskqueue.add(url="/tasks/rebuild_ranking",
+                          params={"cursor": cursor})
+
+
+class MigrateAncestors(BaseHandler):
+    # moves Comments and Likes stored before they had their post as
+    # parent into the post's entity group, a batch per task
+    def get(self):
+        self.post()
+
+    def post(self):
+        kind = self.request.get("kind", "Comment")
+        cursor = migrations.move_under_posts(kind, self.request.get("cursor"))
+        if cursor:
+            taskqueue.add(url="/tasks/migrate_ancestors",
+                          params={"kind": kind, "cursor": cursor})
+        elif kind == "Comment":
+            taskqueue.add(url="/tasks/migrate_ancestors",
+                          params={"kind": "Like"})
+        else:
+            taskqueue.add(url="/tasks/reconcile_votes")
+
+
+class IndexUsernames(BaseHandler):
+    # creates the Username entities of users who signed up before
+    # they existed, a batch per task
+    def get(self):
+        self.post()
+
+    def post(self):
+        cursor = migrations.index_usernames(self.request.get("cursor"))
+        if cursor:
+            taskqueue.add(url="/tasks/index_usernames",
+                          params={"cursor": cursor})
+
+
+class ThreadComments(BaseHandler):
+    # gives the comments written before replies existed their thread
+    # path, a batch per task
+    def get(self):
+        self.post()
+
+    def post(self):
+        cursor = migrations.thread_comments(self.request.get("cursor"))
+        if cursor:
+            taskqueue.add(url="/tasks/thread_comments",
+                          params={"cursor": cursor})
+
+
+class RenderMarkup(BaseHandler):
+    # renders the Markdown of posts and then comments saved before it
+    # was supported, or by an older markup.VERSION, a batch per task
+    def get(self):
+        self.post()
+
+    def post(self):
+        kind = self.request.get("kind", "Blog")
+        cursor = migrations.render_markup(kind, self.request.get("cursor"))
+        if cursor:
+            taskqueue.add(url="/tasks/render_markup",
+                          params={"kind": kind, "cursor": cursor})
+        elif kind == "Blog":
+            # the index caches excerpts
+            cache.bump_front()
+            taskqueue.add(url="/tasks/render_markup",
+                          params={"kind": "Comment"})
+
+
+class BuildSearchIndex(BaseHandler):
+    # indexes every post and comment for search from scratch, a batch
+    # of posts per task. Run it once to index posts written before
+    # search existed
+    def get(self):
+        self.post()
+
+    def post(self):
+        cursor = search.build_index(self.request.get("cursor"))
+        if cursor:
+            taskqueue.add(url="/tasks/build_search_index",
+                          params={"cursor": cursor})
+
 app = webapp2.WSGIApplication([('/?', Greet),
                                ('/blog/signup', SignUp),
                                ('/blog/login', Login),
                                ('/blog', MainPage),
+                               ('/blog/page.json', PostsPage),
+                               ('/blog/search', SearchPosts),
+                               ('/blog/(top|trending)', RankedPosts),
+                               ('/blog/user/([a-zA-Z0-9_-]+)', UserProfile),
                                ('/blog/newpost', NewPost),
                                ('/blog/(\d+)', ShowPost),
                                ('/blog/(\d+)/edit', EditPost),
                                ('/blog/(\d+)/delete', DeletePost),
                                ('/blog/(\d+)/vote/(.+)', NewVote),
+                               ('/blog/(\d+)/comments.json', CommentsPage),
                                ('/blog/(\d+)/comment', NewComment),
+                               ('/blog/(\d+)/comment/(\d+)/replies', CommentReplies),
                                ('/blog/(\d+)/comment/(\d+)/edit', EditComment),
                                ('/blog/(\d+)/comment/(\d+)/delete', DeleteComment),
-                               ('/blog/logout', Logout)],
-                              debug=True)
+                               ('/blog/logout', Logout),
+                               ('/_stats', Stats),
+                               ('/_stats/cache', CacheStats),
+                               ('/tasks/reconcile_votes', ReconcileVotes),
+                               ('/tasks/reconcile_user_stats', ReconcileUserStats),
+                               ('/tasks/redecay_ranking', RedecayRanking),
+                               ('/tasks/rebuild_ranking', RebuildRanking),
+                               ('/tasks/cascade_delete', CascadeDelete),
+                               ('/tasks/migrate_ancestors', MigrateAncestors),
+                               ('/tasks/index_usernames', IndexUsernames),
+                               ('/tasks/thread_comments', ThreadComments),
+                               ('/tasks/render_markup', RenderMarkup),
+                               ('/tasks/build_search_index', BuildSearchIndex)],
+                              debug=True,
+                              config={
+                                  # handler: {"user" or "ip":
+                                  #           (tokens per second, burst)}
+                                  "rate_limits": {
+                                      "NewVote": {"user": (0.5, 10),
+                                                  "ip": (2.0, 30)},
+                                      "NewComment": {"user": (0.2, 5),
+                                                     "ip": (1.0, 20)},
+                                      "SignUp": {"ip": (0.05, 3)},
+                                  }
+                              })
+
+# times every request; the numbers are at /_stats
+app = profiling.ProfilingMiddleware(app)
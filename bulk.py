@@ -0,0 +1,167 @@
+#######################################################
+# The bulk.py module exports the blog's users, posts,
+# comments and votes to newline-delimited JSON and
+# imports them back, over the Remote API. Entities keep
+# their keys (ids, key names and parents), so the
+# references between them survive the trip.
+#
+#   python bulk.py export --host localhost:8080 blog.jsonl
+#   python bulk.py import --host localhost:8080 blog.jsonl
+#
+# Run it with the App Engine SDK on the PYTHONPATH.
+# Vote counters, search documents and sessions are not
+# exported: rebuild the first two with
+# /tasks/reconcile_votes and /tasks/build_search_index.
+#######################################################
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+
+from google.appengine.ext import db
+from google.appengine.ext.remote_api import remote_api_stub
+
+# registers the model classes with db.class_for_kind
+import models
+
+KINDS = ["User", "Username", "Blog", "Comment", "Like"]
+BATCH_SIZE = 500
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def key_path(key):
+    return list(key.to_path())
+
+
+def encode(value):
+    if isinstance(value, db.Key):
+        return {"__key__": key_path(value)}
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.strftime(DATETIME_FORMAT)}
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict) and "__key__" in value:
+        return db.Key.from_path(*value["__key__"])
+    if isinstance(value, dict) and "__datetime__" in value:
+        return datetime.datetime.strptime(value["__datetime__"],
+                                          DATETIME_FORMAT)
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    return value
+
+
+def to_record(entity):
+    properties = dict((name, encode(prop.get_value_for_datastore(entity)))
+                      for name, prop in entity.properties().items())
+    return {"key": key_path(entity.key()), "properties": properties}
+
+
+def from_record(record):
+    key = db.Key.from_path(*record["key"])
+    model = db.class_for_kind(key.kind())
+    properties = dict((str(name), decode(value))
+                      for name, value in record["properties"].items())
+    return model(key=key, **properties)
+
+
+def export(out, kinds=KINDS, batch_size=BATCH_SIZE):
+    # pages through each kind with a keys-only query and fetches the
+    # entities in batches, so memory use doesn't grow with the data
+    count = 0
+    for kind in kinds:
+        query = db.Query(db.class_for_kind(kind), keys_only=True)
+        while True:
+            keys = query.fetch(batch_size)
+            for entity in db.get(keys):
+                if entity:
+                    out.write(json.dumps(to_record(entity)) + "\n")
+                    count += 1
+            if len(keys) < batch_size:
+                break
+            query.with_cursor(query.cursor())
+        logging.info("Exported %s, %d entities so far", kind, count)
+    return count
+
+
+def import_(lines, checkpoint_path, batch_size=BATCH_SIZE):
+    # writes the records in batches of db.put. After each batch the
+    # number of lines done goes to the checkpoint file, and a rerun
+    # skips them. Puts are idempotent, so repeating a batch that was
+    # cut off halfway is harmless
+    done = 0
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            done = int(f.read() or 0)
+        logging.info("Resuming after line %d", done)
+
+    max_ids = {}
+    batch = []
+    line_number = 0
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        # the ids of lines skipped on a resume still need reserving
+        key = db.Key.from_path(*record["key"])
+        if key.id():
+            group = (key.parent(), key.kind())
+            max_ids[group] = max(max_ids.get(group, 0), key.id())
+        if line_number <= done:
+            continue
+        batch.append(from_record(record))
+        if len(batch) == batch_size:
+            write_batch(batch, checkpoint_path, line_number)
+            batch = []
+    write_batch(batch, checkpoint_path, line_number)
+    reserve_ids(max_ids)
+    return line_number
+
+
+def write_batch(batch, checkpoint_path, line_number):
+    db.put(batch)
+    with open(checkpoint_path, "w") as f:
+        f.write(str(line_number))
+    logging.info("Imported %d lines", line_number)
+
+
+def reserve_ids(max_ids):
+    # keeps the datastore from handing out ids the import just used
+    for (parent, kind), max_id in max_ids.items():
+        db.allocate_id_range(db.Key.from_path(kind, 1, parent=parent),
+                             1, max_id)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Bulk export/import of "
+                                                 "the blog's data")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="newline-delimited JSON file")
+    parser.add_argument("--host", default="localhost:8080")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    remote_api_stub.ConfigureRemoteApiForOAuth(
+        args.host, "/_ah/remote_api",
+        secure=not args.host.startswith("localhost"))
+
+    if args.command == "export":
+        with open(args.path, "w") as out:
+            count = export(out, batch_size=args.batch_size)
+        logging.info("Exported %d entities to %s", count, args.path)
+    else:
+        with open(args.path) as lines:
+            count = import_(lines, args.path + ".checkpoint",
+                            batch_size=args.batch_size)
+        logging.info("Imported %d lines from %s", count, args.path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
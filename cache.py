@@ -0,0 +1,87 @@
+#######################################################
+# The cache.py module caches rendered page fragments in
+# memcache. Fragment keys include a version: one per
+# post and a generation for the front page. Writers bump
+# those versions, so stale fragments are never read
+# again and just expire.
+#######################################################
+
+import time
+import datetime
+
+from google.appengine.api import memcache
+
+FRONT_KEY = "front:generation"
+STATS_NAMESPACE = "cache-stats"
+FRAGMENT_TTL = 24 * 60 * 60
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def post_version_key(post_id):
+    return "post:%d:version" % int(post_id)
+
+
+def get_version(key):
+    # versions start at the current time so a version that memcache
+    # evicted comes back larger than any value it had before
+    version = memcache.get(key)
+    if version is None:
+        memcache.add(key, now_ms())
+        version = memcache.get(key) or now_ms()
+    return version
+
+
+def bump(key):
+    # returns the new version, or None if memcache couldn't be reached
+    return memcache.incr(key, initial_value=now_ms())
+
+
+def front_generation():
+    return get_version(FRONT_KEY)
+
+
+def post_version(post_id):
+    return get_version(post_version_key(post_id))
+
+
+def version_time(version):
+    # versions are millisecond timestamps plus a count of bumps, close
+    # enough to the time of the last change for a Last-Modified header
+    return datetime.datetime.utcfromtimestamp(version / 1000.0)
+
+
+def bump_front():
+    return bump(FRONT_KEY)
+
+
+def bump_post(post_id):
+    bump(post_version_key(post_id))
+
+
+def fragment(key, render):
+    # returns the cached fragment under key, calling render() to
+    # build and store it on a miss
+    value = memcache.get(key)
+    if value is None:
+        memcache.incr("misses", initial_value=0, namespace=STATS_NAMESPACE)
+        value = render()
+        memcache.set(key, value, time=FRAGMENT_TTL)
+    else:
+        memcache.incr("hits", initial_value=0, namespace=STATS_NAMESPACE)
+    return value
+
+
+def set_fragment(key, value):
+    # for writers that know a fragment's new contents better than a
+    # render right after the write would
+    memcache.set(key, value, time=FRAGMENT_TTL)
+
+
+def stats():
+    counts = memcache.get_multi(["hits", "misses"],
+                                namespace=STATS_NAMESPACE)
+    return {"hits": counts.get("hits", 0),
+            "misses": counts.get("misses", 0)}
@@ -0,0 +1,90 @@
+#######################################################
+# The compile_templates.py module is the build step that
+# precompiles everything in templates/ into Python
+# modules in compiled_templates/. In production blog.py
+# loads templates from those modules, so a new instance
+# doesn't have to read and compile each template on its
+# first requests.
+#
+# Run it before every deploy:
+#   python compile_templates.py
+#
+# The compiled modules only load under the jinja2 they
+# were built with, so it refuses to build unless the
+# installed jinja2 is the version app.yaml pins. Next to
+# them it writes a digest of templates/, and blog.py
+# only uses them while the digest still matches, so a
+# stale build never hides an edited template.
+#######################################################
+
+import hashlib
+import os
+import re
+import shutil
+import sys
+import jinja2
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+template_dir = os.path.join(app_dir, 'templates')
+compiled_dir = os.path.join(app_dir, 'compiled_templates')
+digest_path = os.path.join(compiled_dir, 'DIGEST')
+
+JINJA2_RE = re.compile(r"-\s*name:\s*jinja2\s*\n\s*version:\s*[\"']?([^\"'\s]+)")
+
+
+def templates_digest():
+    # covers the name and content of every template and the jinja2
+    # version that runs them
+    digest = hashlib.sha1(jinja2.__version__.encode('utf-8'))
+    for root, dirs, files in os.walk(template_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, template_dir)
+                          .encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+                digest.update(f.read() + b'\0')
+    return digest.hexdigest()
+
+
+def is_current():
+    # whether compiled_templates/ was built from templates/ as they
+    # are now, under this jinja2
+    try:
+        with open(digest_path) as f:
+            return f.read().strip() == templates_digest()
+    except IOError:
+        return False
+
+
+def pinned_version():
+    # the jinja2 version in app.yaml's libraries
+    with open(os.path.join(app_dir, 'app.yaml')) as f:
+        match = JINJA2_RE.search(f.read())
+    return match.group(1) if match else None
+
+
+def compile_all():
+    pinned = pinned_version()
+    if jinja2.__version__ != pinned:
+        raise RuntimeError("app.yaml runs jinja2 %s but %s is installed; "
+                           "compile with jinja2 %s"
+                           % (pinned, jinja2.__version__, pinned))
+    # the environment options must match the ones in blog.py
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                             autoescape=True)
+    if os.path.isdir(compiled_dir):
+        shutil.rmtree(compiled_dir)
+    env.compile_templates(compiled_dir, zip=None,
+                          log_function=lambda message: None)
+    with open(digest_path, 'w') as f:
+        f.write(templates_digest())
+    return sorted(env.list_templates())
+
+
+if __name__ == '__main__':
+    try:
+        names = compile_all()
+    except RuntimeError as e:
+        sys.exit(str(e))
+    print("Compiled %d templates into %s" % (len(names), compiled_dir))
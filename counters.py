@@ -0,0 +1,189 @@
+#######################################################
+# The counters.py module keeps a denormalized vote
+# score for every post. Each post's tally is split over
+# NUM_SHARDS VoteShard entities so that concurrent
+# voters write to different entities, and the summed
+# score is cached in memcache until the next vote.
+# The score each user's posts have received together
+# is sharded the same way, over ScoreShard entities.
+#######################################################
+
+import random
+import logging
+import models
+import ranking
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+NUM_SHARDS = 10
+# a reader that summed the shards just before a vote committed can
+# cache the old score after the vote cleared it; it is only served
+# for this long
+CACHE_TTL = 60
+
+
+def shard_keys(post_id):
+    return [db.Key.from_path("VoteShard", "%d:%d" % (int(post_id), i))
+            for i in range(NUM_SHARDS)]
+
+
+def cache_key(post_id):
+    return "votes:%d" % int(post_id)
+
+
+class CountRpc(object):
+    # a post's score, fetched from the shards in the background when
+    # memcache doesn't have it
+    def __init__(self, post_id):
+        self.post_id = post_id
+        self.score = memcache.get(cache_key(post_id))
+        if self.score is None:
+            self.rpc = db.get_async(shard_keys(post_id))
+
+    def get_result(self):
+        if self.score is None:
+            shards = filter(None, self.rpc.get_result())
+            self.score = sum(s.ups - s.downs for s in shards)
+            memcache.add(cache_key(self.post_id), self.score,
+                         time=CACHE_TTL)
+        return self.score
+
+
+def get_count_async(post_id):
+    return CountRpc(post_id)
+
+
+def get_count(post_id):
+    # net score of a post: O(NUM_SHARDS) keyed gets on a cache miss
+    return get_count_async(post_id).get_result()
+
+
+def vote_value(status):
+    return {True: 1, False: -1}.get(status, 0)
+
+
+def cast_vote(post, user, status):
+    # sets user's vote on post to status: True (like), False (dislike)
+    # or None (no vote), updating the Like, one counter shard, the
+    # post's ranking and one shard of its author's score in the same
+    # transaction
+    post_id = post.key().id()
+    vote_key = models.Like.key_for(post.key(), user.key())
+    shard_key = random.choice(shard_keys(post_id))
+    author_key = models.Blog.author.get_value_for_datastore(post)
+
+    def txn():
+        shard = db.get(shard_key) or models.VoteShard(key=shard_key,
+                                                      post_id=post_id)
+        vote = db.get(vote_key)
+        old_status = vote.status if vote else None
+        if old_status is True:
+            shard.ups -= 1
+        elif old_status is False:
+            shard.downs -= 1
+        if status is True:
+            shard.ups += 1
+        elif status is False:
+            shard.downs += 1
+
+        if status is None:
+            if vote:
+                vote.delete()
+            shard.put()
+        else:
+            if vote:
+                vote.status = status
+            else:
+                vote = models.Like(key=vote_key, user=user, post=post,
+                                   status=status)
+            db.put([shard, vote])
+        delta = vote_value(status) - vote_value(old_status)
+        adjust_user_score(author_key, delta)
+        ranking.adjust(post.key(), votes=delta)
+
+    options = db.create_transaction_options(xg=True)
+    db.run_in_transaction_options(options, txn)
+    memcache.delete_multi([cache_key(post_id), user_cache_key(author_key)])
+
+
+def reconcile(post_id):
+    # recounts a post's votes from the Like table and corrects its
+    # shards only if their tallies are off, in one write to the first
+    # shard. The count and the shards are read in the same
+    # transaction, so a vote committed in between makes it retry
+    # instead of being overwritten. Returns whether anything changed
+    post_id = int(post_id)
+
+    def txn():
+        ups = models.Like.count_by_status(post_id, True)
+        downs = models.Like.count_by_status(post_id, False)
+        keys = shard_keys(post_id)
+        shards = db.get(keys)
+        ups_off = ups - sum(s.ups for s in shards if s)
+        downs_off = downs - sum(s.downs for s in shards if s)
+        if not ups_off and not downs_off:
+            return False
+        first = shards[0] or models.VoteShard(key=keys[0], post_id=post_id)
+        first.ups += ups_off
+        first.downs += downs_off
+        first.put()
+        logging.info("Reconciled votes of post %d: +%d -%d", post_id, ups,
+                     downs)
+        return True
+
+    options = db.create_transaction_options(xg=True)
+    changed = db.run_in_transaction_options(options, txn)
+    if changed:
+        memcache.delete(cache_key(post_id))
+    return changed
+
+
+def delete_counts(post_id):
+    db.delete(shard_keys(post_id))
+    memcache.delete(cache_key(post_id))
+
+
+def user_shard_keys(user_key):
+    return [db.Key.from_path("ScoreShard",
+                             "%s:%d" % (user_key.id_or_name(), i))
+            for i in range(NUM_SHARDS)]
+
+
+def user_cache_key(user_key):
+    return "score:%s" % user_key.id_or_name()
+
+
+def adjust_user_score(user_key, delta):
+    # adds delta to one shard of the user's score, chosen at random.
+    # Joins the caller's transaction if there is one; the caller
+    # clears user_cache_key once it has committed
+    shard_key = random.choice(user_shard_keys(user_key))
+
+    def txn():
+        shard = db.get(shard_key) or models.ScoreShard(key=shard_key)
+        shard.score += delta
+        shard.put()
+
+    if db.is_in_transaction():
+        txn()
+    else:
+        db.run_in_transaction(txn)
+        memcache.delete(user_cache_key(user_key))
+
+
+def get_user_score(user_key):
+    score = memcache.get(user_cache_key(user_key))
+    if score is None:
+        shards = filter(None, db.get(user_shard_keys(user_key)))
+        score = sum(s.score for s in shards)
+        memcache.add(user_cache_key(user_key), score, time=CACHE_TTL)
+    return score
+
+
+def set_user_score(user_key, score):
+    # for the reconcile job, like reconcile() above
+    shards = [models.ScoreShard(key=key) for key in user_shard_keys(user_key)]
+    shards[0].score = score
+    db.put(shards)
+    memcache.delete(user_cache_key(user_key))
@@ -0,0 +1,932 @@
+#######################################################
+# The loadtest.py module benchmarks the app locally. It
+# boots blog.app on the App Engine testbed's datastore,
+# memcache and task queue stubs, seeds synthetic users,
+# posts, comments and votes, and then sends a weighted
+# mix of index, permalink, vote and comment requests
+# from several threads. Per handler it reports
+# throughput, p50/p95/p99 latency and datastore RPCs
+# (the numbers come from profiling.py), plus the time
+# to render a post with a very long discussion.
+#
+#   python loadtest.py --users 50 --posts 200 --requests 2000
+#
+# --scenario picks a narrower benchmark instead of the
+# mix: coldstart times fresh processes booting the app
+# and serving their first pages, with compiled and with
+# source templates; growth times a post's page as 100k
+# comments and votes pile up on other posts; voters has
+# hundreds of users vote on one post at once; writeread
+# times a write, its redirect and the page it lands on;
+# import runs a million entities through bulk.py; feeds
+# times the top and trending feeds as 100k votes pile up;
+# auth times logging in apart from an authenticated
+# request.
+#
+# Run it with the App Engine SDK on the PYTHONPATH.
+# Each run is appended to loadtest_results.json under
+# the current git commit and compared with the last
+# run of the same settings, so a regression shows up
+# as soon as the commit that caused it is measured.
+# The stubs are in-process and the threads share the
+# GIL, so compare runs with each other, not with
+# production numbers.
+#######################################################
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import webapp2
+
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+RESULTS_FILE = "loadtest_results.json"
+DEFAULT_MIX = "front=30,post=50,vote=10,comment=10"
+HANDLERS = {"front": "MainPage", "post": "ShowPost", "vote": "NewVote",
+            "comment": "NewComment"}
+# comments and votes on each post add_unrelated writes
+UNRELATED_PER_POST = 10
+# comments and votes on each post in the writeread scenario, few
+# enough that every comment is on the post's first page
+WRITES_PER_POST = 10
+# comments and votes on each post of the import scenario's data
+IMPORT_COMMENTS = 4
+IMPORT_VOTES = 5
+# the first user id of the feeds scenario's made up voters
+FEED_VOTER_IDS = 10 ** 9
+
+# imported by boot(), once the stubs are in place: profiling.py hooks
+# into the API proxy that testbed.activate() replaces
+blog = models = counters = profiling = ranking = None
+
+
+def boot(consistency=1, datastore_file=None):
+    # consistency is the chance a global query sees a write that has
+    # not been read by key or ancestor yet. With a datastore_file the
+    # datastore is kept in sqlite there instead of in memory
+    global blog, models, counters, profiling, ranking
+    bed = testbed.Testbed()
+    bed.activate()
+    # by default every query sees every write, as if the seeding had
+    # long settled
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=consistency)
+    if datastore_file:
+        bed.init_datastore_v3_stub(consistency_policy=policy,
+                                   use_sqlite=True,
+                                   datastore_file=datastore_file)
+    else:
+        bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    import blog
+    import models
+    import counters
+    import profiling
+    import ranking
+    return bed
+
+
+def seed(args, rng):
+    # returns the users as (key, session token) pairs, the post keys
+    # and the ids of each post's top level comments
+    start = time.time()
+    users = make_users("user", args.users)
+
+    now = datetime.datetime.utcnow()
+    posts = []
+    for i in range(args.posts):
+        author_key = rng.choice(users)[0]
+        posts.append(models.Blog(
+            title="Post %d" % i, blog=words(rng, 150), author=author_key,
+            date=now - datetime.timedelta(minutes=i)))
+        posts[-1].render_body()
+    db.put(posts)
+
+    threads = {}
+    for post in posts:
+        threads[post.key()] = add_comments(
+            rng, post, users, rng.randint(0, 2 * args.comments))
+    add_votes(rng, posts, users, args.votes)
+    print("Seeded %d users, %d posts in %.1fs"
+          % (len(users), len(posts), time.time() - start))
+    return users, [post.key() for post in posts], threads
+
+
+def make_users(prefix, count):
+    # returns count new users as (key, session token) pairs
+    users = []
+    for i in range(count):
+        user = models.User.create("%s%d" % (prefix, i), "x")
+        token = "loadtest-session-%s%d" % (prefix, i)
+        models.Session(key_name=token, user=user,
+                       username=user.username).put()
+        users.append((user.key(), token))
+    return users
+
+
+def add_comments(rng, post, users, count, reply_ratio=0.3):
+    # a share of the comments are replies to an earlier one
+    comments = []
+    replies = {}
+    for _ in range(count):
+        reply_to = None
+        if comments and rng.random() < reply_ratio:
+            reply_to = rng.choice(comments)
+            replies[reply_to.key()] = replies.get(reply_to.key(), 0) + 1
+        comments.append(models.Comment.new(post, rng.choice(users)[0],
+                                           words(rng, 30), reply_to))
+    for comment in comments:
+        comment.reply_count = replies.get(comment.key(), 0)
+    for start in range(0, len(comments), 500):
+        db.put(comments[start:start + 500])
+    post.comment_count = len(comments)
+    post.put()
+    return [c.key().id() for c in comments if c.depth == 0]
+
+
+def add_votes(rng, posts, users, per_post):
+    for post in posts:
+        author_key = models.Blog.author.get_value_for_datastore(post)
+        voters = [key for key, _ in users if key != author_key]
+        likes = [models.Like(key=models.Like.key_for(post.key(), key),
+                             user=key, post=post,
+                             status=rng.random() < 0.8)
+                 for key in rng.sample(voters, min(per_post, len(voters)))]
+        db.put(likes)
+        counters.reconcile(post.key().id())
+        post.score = sum(1 if like.status else -1 for like in likes)
+    db.put(posts)
+
+
+def add_unrelated(rng, users, entities):
+    # adds old posts, each with UNRELATED_PER_POST comments and as many
+    # votes, until at least entities comments and votes were added.
+    # Returns how many were
+    added = 0
+    date = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    while added < entities:
+        posts = [models.Blog(title="Unrelated", blog=words(rng, 50),
+                             author=rng.choice(users)[0], date=date)
+                 for _ in range(50)]
+        db.put(posts)
+        children = []
+        for post in posts:
+            for user_key, _ in rng.sample(users, UNRELATED_PER_POST):
+                children.append(models.Like(
+                    key=models.Like.key_for(post.key(), user_key),
+                    user=user_key, post=post, status=rng.random() < 0.8))
+                children.append(models.Comment.new(post, user_key,
+                                                   words(rng, 20)))
+        for start in range(0, len(children), 500):
+            db.put(children[start:start + 500])
+        added += len(children)
+    return added
+
+
+def add_feed_votes(rng, posts, count, first_voter):
+    # puts count votes on random posts, each by a made up user with an
+    # id from first_voter up, and updates the posts' score and hotness
+    # like ranking.adjust would
+    deltas = {}
+    votes = []
+    for i in range(count):
+        index = rng.randrange(len(posts))
+        post = posts[index]
+        user_key = db.Key.from_path("User", first_voter + i)
+        status = rng.random() < 0.8
+        votes.append(models.Like(key=models.Like.key_for(post.key(),
+                                                         user_key),
+                                 user=user_key, post=post, status=status))
+        deltas[index] = deltas.get(index, 0) + (1 if status else -1)
+    for start in range(0, len(votes), 500):
+        db.put(votes[start:start + 500])
+    for index, delta in deltas.items():
+        posts[index].score = (posts[index].score or 0) + delta
+        ranking.rerank(posts[index])
+    db.put([posts[index] for index in deltas])
+
+
+def words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+WORDS = ("the quick brown fox jumps over lazy dog blog post comment vote "
+         "engine app cache query index thread reply page memcache "
+         "datastore latency python template render user score").split()
+
+
+def parse_mix(mix):
+    weights = []
+    for part in mix.split(","):
+        route, weight = part.split("=")
+        if route not in HANDLERS:
+            raise ValueError("unknown route %r in --mix" % route)
+        weights.append((route, float(weight)))
+    return weights
+
+
+def make_requests(args, rng, users, post_keys, threads):
+    # the whole run is drawn up front from the seed, so two runs with
+    # the same settings send the same requests. Recent posts are read
+    # more, like on the real site
+    weights = parse_mix(args.mix)
+    total = sum(weight for _, weight in weights)
+    requests = []
+    for _ in range(args.requests):
+        pick = rng.uniform(0, total)
+        for route, weight in weights:
+            pick -= weight
+            if pick <= 0:
+                break
+        user_key, token = rng.choice(users)
+        post_key = post_keys[min(int(rng.expovariate(5.0 / len(post_keys))),
+                                 len(post_keys) - 1)]
+        post_id = post_key.id()
+        if route == "front":
+            requests.append((route, "/blog", None, token))
+        elif route == "post":
+            requests.append((route, "/blog/%d" % post_id, None, token))
+        elif route == "vote":
+            requests.append((route, "/blog/%d/vote/%s"
+                             % (post_id, rng.choice(["like", "dislike"])),
+                             {}, token))
+        else:
+            params = {"content": words(rng, 20)}
+            if threads[post_key] and rng.random() < 0.3:
+                params["reply_to"] = str(rng.choice(threads[post_key]))
+            requests.append((route, "/blog/%d/comment" % post_id, params,
+                             token))
+    return requests
+
+
+def respond(request):
+    # token None sends no session cookie
+    route, path, post, token = request
+    headers = {"Cookie": "session=%s" % token} if token else {}
+    req = webapp2.Request.blank(
+        path, POST=post, headers=headers,
+        remote_addr="10.0.0.%d" % (hash(token) % 250))
+    return req.get_response(blog.app)
+
+
+def send(request):
+    return respond(request).status_int
+
+
+def run(requests, concurrency):
+    # sends the requests from concurrency threads; returns the seconds
+    # it took and the count of each status per route
+    pending = list(reversed(requests))
+    lock = threading.Lock()
+    statuses = {}
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                request = pending.pop()
+            status = send(request)
+            with lock:
+                counts = statuses.setdefault(request[0], {})
+                counts[str(status)] = counts.get(str(status), 0) + 1
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.time() - start, statuses
+
+
+def reset_samples():
+    with profiling._samples_lock:
+        profiling._samples.clear()
+
+
+def measure_mix(args, rng, users, post_keys, threads):
+    requests = make_requests(args, rng, users, post_keys, threads)
+    # the first requests fill memcache and the fragment cache
+    run(requests[:args.warmup], args.concurrency)
+    reset_samples()
+    seconds, statuses = run(requests[args.warmup:], args.concurrency)
+    sent = len(requests) - args.warmup
+    report = {"requests": sent, "seconds": round(seconds, 2),
+              "throughput": round(sent / seconds, 1) if seconds else 0,
+              "statuses": statuses, "handlers": profiling.summary()}
+    return report
+
+
+def measure_long_thread(args, rng, users):
+    # time to render a post with args.long_thread comments, once with
+    # empty caches and then warm
+    post = models.Blog(title="Long discussion", blog=words(rng, 150),
+                       author=users[0][0])
+    post.render_body()
+    post.put()
+    add_comments(rng, post, users, args.long_thread)
+    request = ("post", "/blog/%d" % post.key().id(), None, users[1][1])
+    memcache.flush_all()
+    reset_samples()
+    send(request)
+    cold = profiling.summary().get("ShowPost")
+    reset_samples()
+    for _ in range(args.long_thread_repeat):
+        send(request)
+    return {"comments": args.long_thread, "cold": cold,
+            "warm": profiling.summary().get("ShowPost")}
+
+
+def time_request(request, handler, repeat, cold=False):
+    # p50 wall time and datastore RPCs of sending request repeat
+    # times, with memcache flushed before each one when cold
+    reset_samples()
+    for _ in range(repeat):
+        if cold:
+            memcache.flush_all()
+        send(request)
+    stats = profiling.summary()[handler]
+    return {"wall_ms": stats["wall_ms"]["p50"],
+            "rpcs": stats["rpc_count"]["p50"]}
+
+
+def git_commit():
+    try:
+        sha = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"]).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain",
+                                         "--untracked-files=no"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return sha + ("-dirty" if dirty else "")
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(previous, current):
+    # prints the change in latency and RPCs per handler since previous
+    print("\nCompared with %s (%s):" % (previous["commit"], previous["date"]))
+    old = previous["mix"]["handlers"]
+    for handler, stats in sorted(current["mix"]["handlers"].items()):
+        if handler not in old:
+            continue
+        changes = []
+        for field, p in (("wall_ms", "p50"), ("wall_ms", "p95"),
+                         ("rpc_count", "p50")):
+            before = old[handler][field][p]
+            after = stats[field][p]
+            change = "%+.0f%%" % ((after - before) * 100.0 / before) \
+                if before else "n/a"
+            changes.append("%s %s %s -> %s (%s)" % (field, p, before, after,
+                                                    change))
+        print("  %-12s %s" % (handler, "; ".join(changes)))
+
+
+def print_mix(result):
+    mix = result["mix"]
+    print("\n%d requests in %.1fs: %.1f requests/s"
+          % (mix["requests"], mix["seconds"], mix["throughput"]))
+    print("%-12s %8s %8s %8s %8s %8s" % ("handler", "requests", "p50 ms",
+                                         "p95 ms", "p99 ms", "RPCs p50"))
+    for handler, stats in sorted(mix["handlers"].items()):
+        wall = stats["wall_ms"]
+        print("%-12s %8d %8.1f %8.1f %8.1f %8d"
+              % (handler, stats["requests"], wall["p50"], wall["p95"],
+                 wall["p99"], stats["rpc_count"]["p50"]))
+    print("statuses: %s" % json.dumps(mix["statuses"], sort_keys=True))
+    thread = result.get("long_thread")
+    if thread:
+        for phase in ("cold", "warm"):
+            if thread[phase]:
+                print("post with %d comments, %s: %.1f ms, %d RPCs"
+                      % (thread["comments"], phase,
+                         thread[phase]["wall_ms"]["p50"],
+                         thread[phase]["rpc_count"]["p50"]))
+
+
+def start(args, consistency=1):
+    # boots the stubs and the app for a scenario that runs in-process
+    bed = boot(consistency)
+    if not args.rate_limits:
+        # every request comes from a handful of users
+        blog.app.app.config["rate_limits"] = {}
+    return bed
+
+
+def scenario_mix(args):
+    bed = start(args)
+    try:
+        profiling.SAMPLES_PER_HANDLER = args.requests + \
+            args.long_thread_repeat
+        rng = random.Random(args.seed)
+        users, post_keys, threads = seed(args, rng)
+        result = {"mix": measure_mix(args, rng, users, post_keys, threads)}
+        if args.long_thread:
+            result["long_thread"] = measure_long_thread(args, rng, users)
+    finally:
+        bed.deactivate()
+    return result
+
+
+def scenario_growth(args):
+    # times one post's page while --unrelated comments and votes on
+    # other posts are added in --growth-steps steps. Its queries only
+    # read its own entity group, so the time should stay flat
+    bed = start(args)
+    try:
+        rng = random.Random(args.seed)
+        users, post_keys, _ = seed(args, rng)
+        request = ("post", "/blog/%d" % post_keys[0].id(), None,
+                   users[0][1])
+        steps = []
+        added = 0
+        for step in range(args.growth_steps + 1):
+            wanted = args.unrelated * step // args.growth_steps
+            if wanted > added:
+                added += add_unrelated(rng, users, wanted - added)
+            steps.append({
+                "unrelated": added,
+                "cold": time_request(request, "ShowPost", args.repeat,
+                                     cold=True),
+                "warm": time_request(request, "ShowPost", args.repeat)})
+    finally:
+        bed.deactivate()
+    return {"growth": steps}
+
+
+def print_growth(result):
+    steps = result["growth"]
+    print("\n%-10s %12s %10s %12s %10s" % ("unrelated", "cold p50 ms",
+                                          "cold RPCs", "warm p50 ms",
+                                          "warm RPCs"))
+    for step in steps:
+        print("%-10d %12.1f %10d %12.1f %10d"
+              % (step["unrelated"], step["cold"]["wall_ms"],
+                 step["cold"]["rpcs"], step["warm"]["wall_ms"],
+                 step["warm"]["rpcs"]))
+    first, last = steps[0]["cold"]["wall_ms"], steps[-1]["cold"]["wall_ms"]
+    if first:
+        print("cold page time at the largest size: %.0f%% of the smallest"
+              % (last * 100.0 / first))
+
+
+def scenario_voters(args):
+    # --voters users each vote twice, at random, on one new post, from
+    # --concurrency threads. Afterwards the post's counter and score
+    # must match its Like entities
+    bed = start(args)
+    try:
+        rng = random.Random(args.seed)
+        author_key, _ = make_users("author", 1)[0]
+        voters = make_users("voter", args.voters)
+        post = models.Blog(title="Popular", blog=words(rng, 150),
+                           author=author_key)
+        post.render_body()
+        post.put()
+        post_id = post.key().id()
+        requests = [("vote", "/blog/%d/vote/%s"
+                     % (post_id, rng.choice(["like", "dislike"])), {},
+                     token)
+                    for _, token in voters * 2]
+        rng.shuffle(requests)
+        profiling.SAMPLES_PER_HANDLER = len(requests)
+        reset_samples()
+        seconds, statuses = run(requests, args.concurrency)
+        stats = profiling.summary()["NewVote"]
+        memcache.flush_all()
+        votes = {"voters": args.voters, "votes": len(requests),
+                 "seconds": round(seconds, 2),
+                 "throughput": round(len(requests) / seconds, 1)
+                 if seconds else 0,
+                 "wall_ms": stats["wall_ms"], "statuses": statuses["vote"],
+                 "likes": models.Like.count_likes(post_id),
+                 "counter": counters.get_count(post_id),
+                 "score": models.Blog.get_by_id(post_id).score}
+    finally:
+        bed.deactivate()
+    return {"voters": votes}
+
+
+def print_voters(result):
+    votes = result["voters"]
+    print("\n%d votes by %d voters on one post in %.1fs: %.1f votes/s"
+          % (votes["votes"], votes["voters"], votes["seconds"],
+             votes["throughput"]))
+    wall = votes["wall_ms"]
+    print("vote p50 %.1f ms, p95 %.1f ms, p99 %.1f ms"
+          % (wall["p50"], wall["p95"], wall["p99"]))
+    print("statuses: %s" % json.dumps(votes["statuses"], sort_keys=True))
+    print("net score from the Like entities %d, the counter %d, the post %d"
+          " (%s)" % (votes["likes"], votes["counter"], votes["score"],
+                     "consistent" if votes["likes"] == votes["counter"] ==
+                     votes["score"] else "MISMATCH"))
+
+
+def scenario_write_read(args):
+    # --writes comments and votes, alternately, each followed by the
+    # page its redirect points to, timed together like a browser would
+    # see them. Global queries see no write until it is read by key or
+    # ancestor, so a comment only shows on that page if the page reads
+    # it with a strongly consistent query
+    bed = start(args, consistency=0)
+    try:
+        rng = random.Random(args.seed)
+        users = make_users("user", args.users)
+        posts = []
+        for i in range(0, args.writes, WRITES_PER_POST):
+            post = models.Blog(title="Post %d" % i, blog=words(rng, 150),
+                               author=users[0][0])
+            post.render_body()
+            posts.append(post)
+        db.put(posts)
+        cycles = {"comment": [], "vote": []}
+        shown = 0
+        for i in range(args.writes):
+            token = rng.choice(users[1:])[1]
+            post_id = posts[i // WRITES_PER_POST].key().id()
+            if i % 2:
+                marker = "written-%d" % i
+                write = ("comment", "/blog/%d/comment" % post_id,
+                         {"content": marker}, token)
+            else:
+                write = ("vote", "/blog/%d/vote/%s"
+                         % (post_id, rng.choice(["like", "dislike"])), {},
+                         token)
+            began = time.time()
+            location = respond(write).headers.get("Location")
+            if not location:
+                continue
+            page = respond(("post", location, None, token))
+            cycles[write[0]].append((time.time() - began) * 1000)
+            if write[0] == "comment" and marker in page.body:
+                shown += 1
+    finally:
+        bed.deactivate()
+    result = {"comments_shown": shown}
+    for kind, times in cycles.items():
+        times.sort()
+        result[kind] = {"cycles": len(times),
+                        "p50": round(times[len(times) // 2], 1)
+                        if times else 0,
+                        "p95": round(times[int(len(times) * 0.95)], 1)
+                        if times else 0}
+    return {"write_read": result}
+
+
+def print_write_read(result):
+    cycles = result["write_read"]
+    print("\n%-8s %8s %12s %12s" % ("write", "cycles", "p50 ms", "p95 ms"))
+    for kind in ("comment", "vote"):
+        print("%-8s %8d %12.1f %12.1f" % (kind, cycles[kind]["cycles"],
+                                          cycles[kind]["p50"],
+                                          cycles[kind]["p95"]))
+    print("(write, redirect and read of the page, together)")
+    print("new comments shown on the page they redirect to: %d of %d"
+          % (cycles["comments_shown"], cycles["comment"]["cycles"]))
+
+
+def bulk_records(rng, users, entities):
+    # yields bulk.py records of users and their usernames, then posts
+    # each with IMPORT_COMMENTS comments and IMPORT_VOTES votes, until
+    # there are at least entities of them, without holding them all
+    import bulk
+    date = datetime.datetime(2016, 1, 1)
+    user_keys = []
+    for i in range(users):
+        user = models.User(key=db.Key.from_path("User", i + 1),
+                           username="user%d" % i, password_digest="x")
+        user_keys.append(user.key())
+        yield bulk.to_record(user)
+        yield bulk.to_record(models.Username(key_name=user.username,
+                                             user=user.key()))
+    count = 2 * users
+    post_id = 0
+    while count < entities:
+        post_id += 1
+        post_key = db.Key.from_path("Blog", post_id)
+        yield bulk.to_record(models.Blog(key=post_key, title="Post",
+                                         blog=words(rng, 50),
+                                         author=rng.choice(user_keys),
+                                         date=date))
+        for i in range(1, IMPORT_COMMENTS + 1):
+            comment_date = date + datetime.timedelta(minutes=i)
+            yield bulk.to_record(models.Comment(
+                key=db.Key.from_path("Comment", i, parent=post_key),
+                body=words(rng, 20), date=comment_date,
+                author=rng.choice(user_keys), post=post_key,
+                path=models.Comment.path_segment(comment_date, i)))
+        for user_key in rng.sample(user_keys, IMPORT_VOTES):
+            yield bulk.to_record(models.Like(
+                key=models.Like.key_for(post_key, user_key), user=user_key,
+                post=post_key, status=rng.random() < 0.8))
+        count += 1 + IMPORT_COMMENTS + IMPORT_VOTES
+
+
+def scenario_import(args):
+    # writes --entities records to a file, imports it with bulk.py
+    # into an empty sqlite datastore and exports it back
+    import bulk
+    workdir = tempfile.mkdtemp(prefix="loadtest-import-")
+    bed = boot(datastore_file=os.path.join(workdir, "datastore.sqlite"))
+    try:
+        rng = random.Random(args.seed)
+        path = os.path.join(workdir, "blog.jsonl")
+        began = time.time()
+        with open(path, "w") as out:
+            for record in bulk_records(rng, args.users, args.entities):
+                out.write(json.dumps(record) + "\n")
+        generated = time.time()
+        with open(path) as lines:
+            imported = bulk.import_(lines, path + ".checkpoint")
+        import_seconds = time.time() - generated
+        began_export = time.time()
+        with open(os.devnull, "w") as out:
+            exported = bulk.export(out)
+        export_seconds = time.time() - began_export
+    finally:
+        bed.deactivate()
+        shutil.rmtree(workdir)
+    return {"import": {
+        "generate_seconds": round(generated - began, 1),
+        "imported": imported, "exported": exported,
+        "import_seconds": round(import_seconds, 1),
+        "import_rate": round(imported / import_seconds)
+        if import_seconds else 0,
+        "export_seconds": round(export_seconds, 1),
+        "export_rate": round(exported / export_seconds)
+        if export_seconds else 0}}
+
+
+def print_import(result):
+    stats = result["import"]
+    print("\nimported %d entities in %.1fs: %d entities/s"
+          % (stats["imported"], stats["import_seconds"],
+             stats["import_rate"]))
+    print("exported %d entities in %.1fs: %d entities/s"
+          % (stats["exported"], stats["export_seconds"],
+             stats["export_rate"]))
+    if stats["exported"] != stats["imported"]:
+        print("MISMATCH: the export doesn't hold every imported entity")
+
+
+def scenario_feeds(args):
+    # times /blog/top and /blog/trending while --feed-votes votes are
+    # added in --growth-steps steps. Each feed is one query on an
+    # indexed property, so the time shouldn't grow with the votes
+    bed = start(args)
+    try:
+        rng = random.Random(args.seed)
+        users, post_keys, _ = seed(args, rng)
+        posts = db.get(post_keys)
+        token = users[0][1]
+        steps = []
+        added = 0
+        for step in range(args.growth_steps + 1):
+            wanted = args.feed_votes * step // args.growth_steps
+            if wanted > added:
+                # past the seeded users' ids, so no vote replaces another
+                add_feed_votes(rng, posts, wanted - added,
+                               FEED_VOTER_IDS + added)
+                added = wanted
+            measured = {"votes": added}
+            for feed in ("top", "trending"):
+                measured[feed] = time_request(
+                    (feed, "/blog/%s" % feed, None, token), "RankedPosts",
+                    args.repeat, cold=True)
+            steps.append(measured)
+    finally:
+        bed.deactivate()
+    return {"feeds": steps}
+
+
+def print_feeds(result):
+    steps = result["feeds"]
+    print("\n%-10s %12s %10s %15s %13s" % ("votes", "top p50 ms",
+                                          "top RPCs", "trending p50 ms",
+                                          "trending RPCs"))
+    for step in steps:
+        print("%-10d %12.1f %10d %15.1f %13d"
+              % (step["votes"], step["top"]["wall_ms"],
+                 step["top"]["rpcs"], step["trending"]["wall_ms"],
+                 step["trending"]["rpcs"]))
+    for feed in ("top", "trending"):
+        first = steps[0][feed]["wall_ms"]
+        if first:
+            print("%s at the most votes: %.0f%% of the time at the fewest"
+                  % (feed, steps[-1][feed]["wall_ms"] * 100.0 / first))
+
+
+def scenario_auth(args):
+    # times --repeat logins, which hash the password with PBKDF2, and
+    # as many authenticated index requests, with the session in this
+    # instance's cache and with it only in the datastore
+    import sessions
+    import signup_helper
+    bed = start(args)
+    try:
+        users = []
+        for i in range(args.users):
+            user = models.User.create(
+                "user%d" % i, signup_helper.hash_password("secret%d" % i))
+            users.append(user.username)
+        rng = random.Random(args.seed)
+        profiling.SAMPLES_PER_HANDLER = args.repeat
+        reset_samples()
+        tokens = []
+        for _ in range(args.repeat):
+            i = rng.randrange(len(users))
+            response = respond(("login", "/blog/login",
+                                {"username": users[i],
+                                 "password": "secret%d" % i}, None))
+            cookie = response.headers.get("Set-Cookie", "")
+            tokens.append(cookie.split(";")[0].split("=", 1)[-1])
+        result = {"iterations": signup_helper.PBKDF2_ITERATIONS,
+                  "login": profiling.summary()["Login"]["wall_ms"]}
+        for cached in (True, False):
+            reset_samples()
+            for token in tokens:
+                if not cached:
+                    sessions.forget(token)
+                send(("front", "/blog", None, token))
+            stats = profiling.summary()["MainPage"]
+            result["cached" if cached else "uncached"] = {
+                "wall_ms": stats["wall_ms"], "rpcs": stats["rpc_count"]}
+    finally:
+        bed.deactivate()
+    return {"auth": result}
+
+
+def print_auth(result):
+    auth = result["auth"]
+    login = auth["login"]
+    print("\nlogin (PBKDF2, %d iterations): p50 %.1f ms, p95 %.1f ms"
+          % (auth["iterations"], login["p50"], login["p95"]))
+    for phase in ("cached", "uncached"):
+        stats = auth[phase]
+        print("index with the session %s: p50 %.1f ms, p95 %.1f ms, "
+              "%d RPCs" % (phase, stats["wall_ms"]["p50"],
+                           stats["wall_ms"]["p95"], stats["rpcs"]["p50"]))
+
+
+COLD_START_PATHS = ("/", "/blog", "/blog/signup", "/blog/login")
+
+
+def cold_start_child():
+    # runs in a fresh process: times booting the app and the first
+    # request to each page, which is when its templates are loaded
+    began = time.time()
+    bed = boot()
+    booted = time.time()
+    first = {}
+    for path in COLD_START_PATHS:
+        request_start = time.time()
+        webapp2.Request.blank(path).get_response(blog.app)
+        first[path] = round((time.time() - request_start) * 1000, 1)
+    bed.deactivate()
+    print(json.dumps({"boot_ms": round((booted - began) * 1000, 1),
+                      "first_request_ms": first}))
+
+
+def scenario_cold_start(args):
+    # starts args.cold_starts fresh processes loading the templates
+    # from compiled_templates/ and as many reading templates/ (the dev
+    # server's way, so it's the SERVER_SOFTWARE they differ in)
+    import compile_templates
+    compile_templates.compile_all()
+    result = {}
+    for mode, server in (("compiled", "Google App Engine/loadtest"),
+                         ("source", "Development/loadtest")):
+        env = dict(os.environ, SERVER_SOFTWARE=server)
+        runs = []
+        for _ in range(args.cold_starts):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 "--cold-start-child"], env=env)
+            runs.append(json.loads(output.decode("utf-8").splitlines()[-1]))
+        boot_ms = sorted(child["boot_ms"] for child in runs)
+        first_ms = sorted(sum(child["first_request_ms"].values())
+                          for child in runs)
+        result[mode] = {"processes": len(runs),
+                        "boot_ms": boot_ms[len(runs) // 2],
+                        "first_requests_ms": first_ms[len(runs) // 2]}
+    return {"cold_start": result}
+
+
+def print_cold_start(result):
+    print("\n%-9s %10s %10s %22s" % ("templates", "processes", "boot ms",
+                                     "first requests ms"))
+    for mode, stats in sorted(result["cold_start"].items()):
+        print("%-9s %10d %10.1f %22.1f" % (mode, stats["processes"],
+                                           stats["boot_ms"],
+                                           stats["first_requests_ms"]))
+    print("(medians; first requests are %s)" % ", ".join(COLD_START_PATHS))
+
+
+# each scenario returns what it measured, to save with the run, and has
+# a function to print it
+SCENARIOS = {"mix": (scenario_mix, print_mix),
+             "coldstart": (scenario_cold_start, print_cold_start),
+             "growth": (scenario_growth, print_growth),
+             "voters": (scenario_voters, print_voters),
+             "writeread": (scenario_write_read, print_write_read),
+             "import": (scenario_import, print_import),
+             "feeds": (scenario_feeds, print_feeds),
+             "auth": (scenario_auth, print_auth)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the blog against local service stubs")
+    parser.add_argument("--scenario", default="mix",
+                        choices=sorted(SCENARIOS))
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--comments", type=int, default=10,
+                        help="average comments per post")
+    parser.add_argument("--votes", type=int, default=10,
+                        help="votes per post")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="route weights, routes: %s"
+                             % ", ".join(sorted(HANDLERS)))
+    parser.add_argument("--long-thread", type=int, default=10000,
+                        help="comments on the long discussion, 0 to skip")
+    parser.add_argument("--long-thread-repeat", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="requests timed per measurement")
+    parser.add_argument("--unrelated", type=int, default=100000,
+                        help="comments and votes on other posts in growth")
+    parser.add_argument("--growth-steps", type=int, default=4,
+                        help="measurements in growth and feeds")
+    parser.add_argument("--feed-votes", type=int, default=100000,
+                        help="votes added in feeds")
+    parser.add_argument("--voters", type=int, default=500,
+                        help="users voting on one post in voters")
+    parser.add_argument("--writes", type=int, default=200,
+                        help="comments and votes sent in writeread")
+    parser.add_argument("--entities", type=int, default=1000000,
+                        help="entities imported and exported in import")
+    parser.add_argument("--cold-starts", type=int, default=5,
+                        help="processes started per mode in coldstart")
+    parser.add_argument("--cold-start-child", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the app's rate limits on")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--results", default=RESULTS_FILE)
+    args = parser.parse_args(argv)
+    args.warmup = min(args.warmup, args.requests // 2)
+    if args.cold_start_child:
+        cold_start_child()
+        return
+
+    measure, print_report = SCENARIOS[args.scenario]
+    result = {"commit": git_commit(),
+              "date": datetime.datetime.utcnow().isoformat(),
+              "settings": dict((name, value)
+                               for name, value in vars(args).items()
+                               if name not in ("results",
+                                               "cold_start_child"))}
+    try:
+        result.update(measure(args))
+    except RuntimeError as e:
+        sys.exit(str(e))
+
+    print_report(result)
+    results = load_results(args.results)
+    previous = [r for r in results if r["settings"] == result["settings"]]
+    if previous and "mix" in result:
+        compare(previous[-1], result)
+    elif previous:
+        print("\nThe last run of these settings, at %s (%s):"
+              % (previous[-1]["commit"], previous[-1]["date"]))
+        print_report(previous[-1])
+    results.append(result)
+    with open(args.results, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("\nSaved to %s" % args.results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
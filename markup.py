@@ -0,0 +1,150 @@
+#######################################################
+# The markup.py module renders the Markdown subset that
+# posts and comments are written in: paragraphs, line
+# breaks, headings, lists, quotes, fenced code, code
+# spans, bold, italics and links. The source is HTML
+# escaped before any rule is applied, so the only tags
+# in the output are the ones the rules write, and links
+# are kept to http(s), mailto and same-site URLs.
+# Posts and comments are rendered when they are saved
+# (see Blog.render_body and Comment.render_body), not
+# on every view.
+#######################################################
+
+import hashlib
+import re
+
+# part of every digest, so changing the rules below re-renders
+# everything on the next /tasks/render_markup run
+VERSION = "1"
+EXCERPT_LENGTH = 300
+
+FENCE_RE = re.compile(r"^```")
+HEADING_RE = re.compile(r"^(#{1,3}) +(.+?)[ #]*$")
+QUOTE_RE = re.compile(r"^&gt; ?")
+BULLET_RE = re.compile(r"^[-*+] +")
+NUMBER_RE = re.compile(r"^\d+[.)] +")
+
+CODE_RE = re.compile(r"`([^`\n]+)`")
+LINK_RE = re.compile(r"\[([^\]\n]+)\]\(([^)\s]+)\)")
+# a same-site path can't start with // or /\, which browsers read as
+# another host
+SAFE_URL_RE = re.compile(r"^(https?://|mailto:|/(?![/\\])|#)", re.I)
+STRONG_RE = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*", re.U)
+EM_STAR_RE = re.compile(r"(?<![\w*])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![\w*])",
+                        re.U)
+EM_UNDERSCORE_RE = re.compile(r"(?<!\w)_(?=\S)(.+?)(?<=\S)_(?!\w)", re.U)
+PLACEHOLDER_RE = re.compile("\x00(\\d+)\x00")
+
+
+def escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;") \
+               .replace(">", "&gt;").replace('"', "&quot;") \
+               .replace("'", "&#39;")
+
+
+def digest(source):
+    # tells whether source needs rendering again
+    return hashlib.sha1((VERSION + ":" + source).encode("utf-8")).hexdigest()
+
+
+def render(source):
+    text = source.replace("\x00", "").replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(blocks(escape(text).split("\n")))
+
+
+def excerpt(source, length=EXCERPT_LENGTH):
+    # the start of source, cut at the last space or line break before
+    # length characters, rendered
+    source = source.strip()
+    if len(source) <= length:
+        return render(source)
+    cut = max(source.rfind(" ", 0, length), source.rfind("\n", 0, length))
+    if cut < length // 2:
+        cut = length
+    return render(source[:cut].rstrip() + u"\u2026")
+
+
+def starts_block(line):
+    return bool(FENCE_RE.match(line) or HEADING_RE.match(line) or
+                QUOTE_RE.match(line) or BULLET_RE.match(line) or
+                NUMBER_RE.match(line))
+
+
+def blocks(lines):
+    # renders escaped lines into a list of block elements
+    html = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            i += 1
+        elif FENCE_RE.match(line):
+            # runs to the closing fence, or to the end if there is none
+            end = i + 1
+            while end < len(lines) and not FENCE_RE.match(lines[end]):
+                end += 1
+            html.append("<pre><code>%s</code></pre>"
+                        % "\n".join(lines[i + 1:end]))
+            i = end + 1
+        elif HEADING_RE.match(line):
+            # the post title is an h2, so headings start below it
+            match = HEADING_RE.match(line)
+            level = len(match.group(1)) + 2
+            html.append("<h%d>%s</h%d>" % (level, inline(match.group(2)),
+                                           level))
+            i += 1
+        elif QUOTE_RE.match(line):
+            end = i
+            while end < len(lines) and QUOTE_RE.match(lines[end]):
+                end += 1
+            quoted = [QUOTE_RE.sub("", l) for l in lines[i:end]]
+            html.append("<blockquote>%s</blockquote>"
+                        % "\n".join(blocks(quoted)))
+            i = end
+        elif BULLET_RE.match(line) or NUMBER_RE.match(line):
+            marker = BULLET_RE if BULLET_RE.match(line) else NUMBER_RE
+            tag = "ul" if marker is BULLET_RE else "ol"
+            items = []
+            while i < len(lines) and marker.match(lines[i]):
+                items.append("<li>%s</li>" % inline(marker.sub("", lines[i])))
+                i += 1
+            html.append("<%s>%s</%s>" % (tag, "".join(items), tag))
+        else:
+            end = i + 1
+            while end < len(lines) and lines[end].strip() and \
+                    not starts_block(lines[end]):
+                end += 1
+            html.append("<p>%s</p>" % inline("\n".join(lines[i:end])))
+            i = end
+    return html
+
+
+def inline(text):
+    # text is escaped already. Code spans and links are swapped for
+    # placeholders first, so the emphasis rules can't reach into them
+    kept = []
+
+    def keep(html):
+        kept.append(html)
+        return "\x00%d\x00" % (len(kept) - 1)
+
+    def restore(text):
+        return PLACEHOLDER_RE.sub(lambda m: kept[int(m.group(1))], text)
+
+    def link(match):
+        url = match.group(2)
+        if not SAFE_URL_RE.match(url):
+            return match.group(0)
+        return keep('<a href="%s" rel="nofollow">%s</a>'
+                    % (url, restore(emphasis(match.group(1)))))
+
+    text = CODE_RE.sub(lambda m: keep("<code>%s</code>" % m.group(1)), text)
+    text = LINK_RE.sub(link, text)
+    return restore(emphasis(text).replace("\n", "<br>\n"))
+
+
+def emphasis(text):
+    text = STRONG_RE.sub(r"<strong>\1</strong>", text)
+    text = EM_STAR_RE.sub(r"<em>\1</em>", text)
+    return EM_UNDERSCORE_RE.sub(r"<em>\1</em>", text)
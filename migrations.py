@@ -0,0 +1,122 @@
+#######################################################
+# The migrations.py module holds one-off data migrations
+# that bring entities written by older versions of the
+# app up to the current models. They run in batches
+# from the task queue (see the /tasks handlers in
+# blog.py).
+#######################################################
+
+import logging
+import models
+
+from google.appengine.ext import db
+
+BATCH_SIZE = 100
+
+
+def move_under_posts(kind, cursor=None):
+    # copies root Comments or Likes (kind) to new entities parented by
+    # their post and deletes the originals. Returns the cursor of the
+    # next batch, or None when done
+    model = {"Comment": models.Comment, "Like": models.Like}[kind]
+    query = model.all()
+    if cursor:
+        query.with_cursor(cursor)
+    batch = query.fetch(BATCH_SIZE)
+
+    moved = []
+    old_keys = []
+    for entity in batch:
+        if entity.key().parent():
+            continue
+        post_key = model.post.get_value_for_datastore(entity)
+        values = dict((name, prop.get_value_for_datastore(entity))
+                      for name, prop in model.properties().items())
+        if kind == "Like":
+            user_key = model.user.get_value_for_datastore(entity)
+            moved.append(model(key=model.key_for(post_key, user_key),
+                               **values))
+        else:
+            moved.append(model(parent=post_key, **values))
+        old_keys.append(entity.key())
+    db.put(moved)
+    db.delete(old_keys)
+    logging.info("Moved %d %s entities under their posts",
+                 len(moved), kind)
+
+    if len(batch) == BATCH_SIZE:
+        return query.cursor()
+    return None
+
+
+def index_usernames(cursor=None):
+    # adds the missing Username entity of each User. If two old users
+    # share a name, the first one claims it and the clash is logged.
+    # Returns the cursor of the next batch, or None when done
+    query = models.User.all()
+    if cursor:
+        query.with_cursor(cursor)
+    batch = query.fetch(BATCH_SIZE)
+
+    for user in batch:
+        index = models.Username.get_or_insert(user.username, user=user)
+        if models.Username.user.get_value_for_datastore(index) != user.key():
+            logging.warning("Username %s is used by more than one user",
+                            user.username)
+
+    if len(batch) == BATCH_SIZE:
+        return query.cursor()
+    return None
+
+
+def thread_comments(cursor=None):
+    # gives the comments written before replies existed a path, which
+    # makes them top level threads. Returns the cursor of the next
+    # batch, or None when done
+    query = models.Comment.all()
+    if cursor:
+        query.with_cursor(cursor)
+    batch = query.fetch(BATCH_SIZE)
+
+    threaded = []
+    for comment in batch:
+        if comment.path:
+            continue
+        comment.path = models.Comment.path_segment(comment.date,
+                                                   comment.key().id())
+        comment.depth = 0
+        comment.reply_count = 0
+        threaded.append(comment)
+    db.put(threaded)
+    logging.info("Threaded %d comments", len(threaded))
+
+    if len(batch) == BATCH_SIZE:
+        return query.cursor()
+    return None
+
+
+def render_markup(kind, cursor=None):
+    # renders the Markdown of the Blogs or Comments (kind) whose HTML
+    # is missing or was rendered by an older markup.VERSION. Each is
+    # re-read and saved in its own transaction, so a vote or reply
+    # landing meanwhile keeps its change. Returns the cursor of the
+    # next batch, or None when done
+    model = {"Blog": models.Blog, "Comment": models.Comment}[kind]
+    query = model.all(keys_only=True)
+    if cursor:
+        query.with_cursor(cursor)
+    keys = query.fetch(BATCH_SIZE)
+
+    def txn(key):
+        entity = model.get(key)
+        if entity and entity.render_body():
+            entity.put()
+            return True
+        return False
+
+    rendered = sum(1 for key in keys if db.run_in_transaction(txn, key))
+    logging.info("Rendered the markup of %d %s entities", rendered, kind)
+
+    if len(keys) == BATCH_SIZE:
+        return query.cursor()
+    return None
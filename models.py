@@ -1,55 +1,317 @@
+import calendar
+import datetime
+
+import markup
+
 from google.appengine.ext import db
 
+# Helpers
+
+def prefetch_refs(entities, *props):
+    # resolves the given ReferenceProperties of all the entities with
+    # one batch get, instead of one get per entity when a template
+    # dereferences them
+    ref_keys = set()
+    for entity in entities:
+        for prop in props:
+            ref_keys.add(prop.get_value_for_datastore(entity))
+    ref_keys.discard(None)
+    referenced = dict((e.key(), e) for e in db.get(list(ref_keys)) if e)
+    for entity in entities:
+        for prop in props:
+            ref_key = prop.get_value_for_datastore(entity)
+            if ref_key in referenced:
+                prop.__set__(entity, referenced[ref_key])
+    return entities
+
+def delete_descendants(parent_key, batch_size=500):
+    # deletes a batch of the entities under parent_key with a single
+    # keys-only query and one batch delete. Returns True once nothing
+    # is left
+    keys = db.Query(keys_only=True).ancestor(parent_key).fetch(batch_size)
+    db.delete(keys)
+    return len(keys) < batch_size
+
 # Models
 
 class User(db.Model):
     username = db.StringProperty(required=True)
     password_digest = db.StringProperty(required=True)
+    # profile stats, kept up to date on write (see adjust_stats). The
+    # score the user's posts received is changed by every vote on any
+    # of them, so it is kept in sharded counters instead (see
+    # counters.adjust_user_score)
+    post_count = db.IntegerProperty(default=0, indexed=False)
+    comment_count = db.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def adjust_stats(cls, user_key, posts=0, comments=0):
+        # joins the caller's transaction if there is one
+        def txn():
+            user = cls.get(user_key)
+            if user:
+                user.post_count = (user.post_count or 0) + posts
+                user.comment_count = (user.comment_count or 0) + comments
+                user.put()
+
+        if db.is_in_transaction():
+            txn()
+        else:
+            db.run_in_transaction(txn)
+
+    @classmethod
+    def set_stats(cls, user_key, posts, comments):
+        def txn():
+            user = cls.get(user_key)
+            if user:
+                user.post_count = posts
+                user.comment_count = comments
+                user.put()
+
+        db.run_in_transaction(txn)
 
     @classmethod
-    def get_by(cls, key, value):
-        return cls.gql("WHERE %s = :1" % key, value).get()
+    def by_username(cls, username):
+        # two gets by key instead of a query on username
+        if not username:
+            return None
+        index = Username.get_by_key_name(username)
+        if index:
+            return cls.get(Username.user.get_value_for_datastore(index))
+        return None
+
+    @classmethod
+    def create(cls, username, password_digest):
+        # claims the username and creates the user in one transaction,
+        # so two signups for the same name can't both succeed. Returns
+        # None if the name is taken
+        def txn():
+            if Username.get_by_key_name(username):
+                return None
+            user = cls(username=username, password_digest=password_digest)
+            user.put()
+            Username(key_name=username, user=user).put()
+            return user
+
+        options = db.create_transaction_options(xg=True)
+        return db.run_in_transaction_options(options, txn)
+
+class Username(db.Model):
+    # key_name is the username; one entity per taken name
+    user = db.ReferenceProperty(User, collection_name="username_index")
+
+class Session(db.Model):
+    # key_name is the random token kept in the login cookie, so a
+    # request is authenticated with one get by key
+    user = db.ReferenceProperty(User, collection_name="sessions")
+    username = db.StringProperty(indexed=False)
+    created = db.DateTimeProperty(auto_now_add=True)
 
 class Blog(db.Model):
     title = db.StringProperty(required=True)
     date = db.DateTimeProperty(auto_now_add=True)
+    # set by edit() only: votes, comments and the ranking jobs put the
+    # post too, and aren't edits
+    last_edited = db.DateTimeProperty()
     blog = db.TextProperty(required=True)
+    # blog rendered from Markdown, in full and cut short for the index,
+    # and the markup.digest of what was rendered (see render_body)
+    blog_html = db.TextProperty()
+    excerpt_html = db.TextProperty()
+    blog_digest = db.StringProperty(indexed=False)
     author = db.ReferenceProperty(User, collection_name="blogs")
+    # ranking of the top and trending feeds, see ranking.py
+    score = db.IntegerProperty(default=0)
+    comment_count = db.IntegerProperty(default=0, indexed=False)
+    hotness = db.FloatProperty(default=0.0)
+
+    def render_body(self):
+        # renders blog, unless it is what was rendered last time.
+        # Returns whether anything changed
+        digest = markup.digest(self.blog)
+        if digest == self.blog_digest:
+            return False
+        self.blog_html = markup.render(self.blog)
+        self.excerpt_html = markup.excerpt(self.blog)
+        self.blog_digest = digest
+        return True
+
+    @classmethod
+    def by_author(cls, user):
+        return cls.all().filter("author =", user).order("-date")
+
+    @classmethod
+    def edit(cls, post_id, title, blog):
+        # in a transaction, so a vote or comment landing at the same
+        # time keeps its change to the ranking properties
+        def txn():
+            post = cls.get_by_id(int(post_id))
+            post.title = title
+            post.blog = blog
+            post.render_body()
+            post.last_edited = datetime.datetime.now()
+            post.put()
+            return post
+
+        return db.run_in_transaction(txn)
 
 class Comment(db.Model):
+    # comments are stored with their post as the entity group parent,
+    # so the ancestor queries below are strongly consistent.
+    # Replies are threaded by path: a top level comment's path is its
+    # own segment, a reply's is its parent's path, "/" and its own
+    # segment. A thread sorts in reading order by path, and all the
+    # replies under a comment, at any depth, are one range of paths
+    MAX_DEPTH = 8
+
     body = db.TextProperty(required=True)
+    # body rendered from Markdown (see render_body)
+    body_html = db.TextProperty()
+    body_digest = db.StringProperty(indexed=False)
     date = db.DateTimeProperty(auto_now_add=True)
     author = db.ReferenceProperty(User, collection_name="comments")
     post = db.ReferenceProperty(Blog, collection_name="comments")
+    reply_to = db.SelfReferenceProperty(collection_name="replies")
+    path = db.StringProperty()
+    depth = db.IntegerProperty(default=0)
+    # direct replies, kept up to date on write (see adjust_replies)
+    reply_count = db.IntegerProperty(default=0, indexed=False)
+
+    @staticmethod
+    def path_segment(date, comment_id):
+        # fixed width milliseconds, so siblings sort oldest first; the
+        # id tells apart siblings written in the same millisecond
+        millis = calendar.timegm(date.utctimetuple()) * 1000 + \
+            date.microsecond // 1000
+        return "%013d-%d" % (millis, comment_id)
 
     @classmethod
-    def by_post(cls, post_id):
-        unsorted = filter(lambda x: x.post.key().id() == int(post_id), cls.all())
-        if unsorted == []:
-            return unsorted
+    def new(cls, post, author, body, reply_to=None):
+        # returns an unsaved comment on post, replying to the comment
+        # reply_to if given. Its id is allocated up front, since the
+        # path holds it. A reply to a comment at MAX_DEPTH is put next
+        # to it instead of under it
+        post_key = post.key()
+        comment_id = db.allocate_ids(
+            db.Key.from_path("Comment", 1, parent=post_key), 1)[0]
+        date = datetime.datetime.now()
+        segment = cls.path_segment(date, comment_id)
+        parent_key = None
+        path = segment
+        depth = 0
+        if reply_to:
+            parent_key = reply_to.key()
+            parent_path = reply_to.path
+            depth = reply_to.depth + 1
+            if depth > cls.MAX_DEPTH:
+                parent_key = cls.reply_to.get_value_for_datastore(reply_to)
+                parent_path = parent_path.rsplit("/", 1)[0]
+                depth = reply_to.depth
+            path = parent_path + "/" + segment
+        comment = cls(key=db.Key.from_path("Comment", comment_id,
+                                           parent=post_key),
+                      body=body, date=date, author=author, post=post,
+                      reply_to=parent_key, path=path, depth=depth)
+        comment.render_body()
+        return comment
+
+    def render_body(self):
+        # renders body, unless it is what was rendered last time.
+        # Returns whether anything changed
+        digest = markup.digest(self.body)
+        if digest == self.body_digest:
+            return False
+        self.body_html = markup.render(self.body)
+        self.body_digest = digest
+        return True
+
+    @classmethod
+    def adjust_replies(cls, comment_key, delta):
+        # joins the caller's transaction if there is one
+        def txn():
+            comment = cls.get(comment_key)
+            if comment:
+                comment.reply_count = max(0, (comment.reply_count or 0) +
+                                          delta)
+                comment.put()
+
+        if db.is_in_transaction():
+            txn()
         else:
-            return sorted(unsorted, key=lambda x: x.date, reverse=True)
+            db.run_in_transaction(txn)
+
+    @classmethod
+    def by_post(cls, post_id):
+        # every comment of a post, threads and all
+        post_key = db.Key.from_path("Blog", int(post_id))
+        return cls.all().ancestor(post_key).order("-date").fetch(None)
+
+    @classmethod
+    def top_level(cls, post_key):
+        # the comments that start a thread, newest first
+        return cls.all().ancestor(post_key).filter("depth =", 0) \
+                        .order("-date")
 
     @classmethod
-    def by_author(cls, user_id):
-        return filter(lambda x: x.user.key().id() == int(user_id), cls.all())
+    def subtree(cls, comment, keys_only=False):
+        # every reply under comment, at any depth, in reading order.
+        # "0" is the character after "/", so this is one range scan
+        return cls.all(keys_only=keys_only) \
+                  .ancestor(comment.key().parent()) \
+                  .filter("path >", comment.path + "/") \
+                  .filter("path <", comment.path + "0") \
+                  .order("path")
+
+    @classmethod
+    def get_for_post(cls, post_id, comment_id):
+        return cls.get_by_id(int(comment_id),
+                             parent=db.Key.from_path("Blog", int(post_id)))
+
+    @classmethod
+    def by_author(cls, user):
+        return cls.all().filter("author =", user).order("-date")
 
 class Like(db.Model):
+    # a vote is stored under its post, keyed by the voter's id, so a
+    # user's vote on a post is a single get and can only exist once
     user = db.ReferenceProperty(User, collection_name="likes", indexed=True)
     post = db.ReferenceProperty(Blog, collection_name="likes", indexed=True)
     status = db.BooleanProperty(required=True)
 
+    @classmethod
+    def key_for(cls, post_key, user_key):
+        return db.Key.from_path(cls.kind(), str(user_key.id_or_name()),
+                                parent=post_key)
+
+    @classmethod
+    def count_by_status(cls, post_id, status):
+        post_key = db.Key.from_path("Blog", int(post_id))
+        return cls.all(keys_only=True).ancestor(post_key) \
+                                      .filter("status =", status).count(None)
+
     @classmethod
     def count_likes(cls, post_id):
-        all_votes = filter(lambda x: x.post.key().id() == int(post_id), cls.all())
-        likes = filter(lambda x: x.status == True, all_votes)
-        total_score = len(likes) - (len(all_votes) - len(likes))
-        return total_score
+        return cls.count_by_status(post_id, True) - \
+               cls.count_by_status(post_id, False)
 
     @classmethod
     def vote_of_post(cls, post, user):
-        user_vote = filter(lambda x: x.post.key().id() == post.key().id() and x.user.username == user.username, cls.all())
-        if len(user_vote) > 0:
-            return user_vote[0].status
+        if not user:
+            return None
+        user_vote = cls.get(cls.key_for(post.key(), user.key()))
+        if user_vote:
+            return user_vote.status
         else:
             return None
+
+class VoteShard(db.Model):
+    # one of counters.NUM_SHARDS tallies of a post's votes, keyed
+    # by "<post_id>:<shard>" so a post's shards can be fetched by key
+    post_id = db.IntegerProperty(required=True)
+    ups = db.IntegerProperty(default=0, indexed=False)
+    downs = db.IntegerProperty(default=0, indexed=False)
+
+class ScoreShard(db.Model):
+    # one of counters.NUM_SHARDS tallies of the score a user's posts
+    # have received, keyed by "<user_id>:<shard>"
+    score = db.IntegerProperty(default=0, indexed=False)
@@ -0,0 +1,145 @@
+#######################################################
+# The profiling.py module is WSGI middleware that times
+# every request: wall time, datastore RPC count and
+# latency, template render time and response size. It
+# keeps a bounded sample of recent requests per
+# handler class, which the admin only /_stats page
+# reports as percentiles. A small fraction of requests
+# can also be run under cProfile, with the profile
+# written to the log. Recording costs a few clock reads
+# per RPC and render, so it can stay on in production.
+#######################################################
+
+import collections
+import cProfile
+import logging
+import os
+import pstats
+import random
+import StringIO
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+SAMPLES_PER_HANDLER = 500
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+
+_local = threading.local()
+_samples = {}
+_samples_lock = threading.Lock()
+
+Sample = collections.namedtuple(
+    "Sample", "wall_ms rpc_count rpc_ms render_ms response_bytes")
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.handler = "unmatched"
+        self.rpc_count = 0
+        self.rpc_ms = 0.0
+        self.render_ms = 0.0
+        self.rpc_starts = {}
+
+
+def current():
+    return getattr(_local, "stats", None)
+
+
+def set_handler(name):
+    stats = current()
+    if stats:
+        stats.handler = name
+
+
+def record_render(ms):
+    stats = current()
+    if stats:
+        stats.render_ms += ms
+
+
+def _pre_call(service, call, request, response, rpc=None):
+    stats = current()
+    if stats:
+        stats.rpc_starts[id(request)] = time.time()
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+    stats = current()
+    if stats:
+        start = stats.rpc_starts.pop(id(request), None)
+        stats.rpc_count += 1
+        if start:
+            stats.rpc_ms += (time.time() - start) * 1000
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    "profiling", _pre_call, "datastore_v3")
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    "profiling", _post_call, "datastore_v3")
+
+
+def record(handler, sample):
+    with _samples_lock:
+        if handler not in _samples:
+            _samples[handler] = collections.deque(maxlen=SAMPLES_PER_HANDLER)
+        _samples[handler].append(sample)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def summary():
+    # {handler: {field: {p50, p95, p99}}} over the recent samples
+    with _samples_lock:
+        samples = dict((h, list(s)) for h, s in _samples.items())
+    report = {}
+    for handler, rows in samples.items():
+        report[handler] = {"requests": len(rows)}
+        for field in Sample._fields:
+            values = [getattr(row, field) for row in rows]
+            report[handler][field] = dict(
+                ("p%d" % p, round(percentile(values, p), 2))
+                for p in (50, 95, 99))
+    return report
+
+
+class ProfilingMiddleware(object):
+    def __init__(self, app, profile_rate=PROFILE_SAMPLE_RATE):
+        self.app = app
+        self.profile_rate = profile_rate
+
+    def __call__(self, environ, start_response):
+        stats = _local.stats = RequestStats()
+        profiler = None
+        if self.profile_rate and random.random() < self.profile_rate:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.time()
+        try:
+            # webapp2 has rendered the whole body by the time it
+            # returns, so this is the full cost of the request
+            body = list(self.app(environ, start_response))
+        finally:
+            wall_ms = (time.time() - start) * 1000
+            if profiler:
+                profiler.disable()
+            _local.stats = None
+        record(stats.handler, Sample(wall_ms, stats.rpc_count, stats.rpc_ms,
+                                     stats.render_ms,
+                                     sum(len(chunk) for chunk in body)))
+        if profiler:
+            self.log_profile(profiler, stats, environ)
+        return body
+
+    def log_profile(self, profiler, stats, environ):
+        out = StringIO.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative") \
+                                          .print_stats(30)
+        logging.info("Profile of %s %s (%s):\n%s",
+                     environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"),
+                     stats.handler, out.getvalue())
@@ -0,0 +1,85 @@
+#######################################################
+# The ranking.py module keeps the numbers behind the
+# "top" and "trending" feeds on each Blog: its net vote
+# score, its comment count and a time-decayed hotness,
+# HN style: points / (age in hours + 2) ^ GRAVITY. They
+# are updated in the same transaction as each vote and
+# comment, and a cron job re-decays the hottest posts,
+# so each feed is one indexed, ordered query.
+#######################################################
+
+import datetime
+import logging
+import models
+
+from google.appengine.ext import db
+
+GRAVITY = 1.8
+COMMENT_POINTS = 0.5
+REDECAY_BATCH = 500
+
+
+def hotness(score, comment_count, date, now=None):
+    now = now or datetime.datetime.utcnow()
+    age_hours = max(0, (now - date).total_seconds() / 3600.0)
+    points = score + COMMENT_POINTS * comment_count
+    return points / (age_hours + 2) ** GRAVITY
+
+
+def rerank(post):
+    post.hotness = hotness(post.score or 0, post.comment_count or 0,
+                           post.date)
+
+
+def adjust(post_key, votes=0, comments=0):
+    # joins the caller's transaction if there is one
+    def txn():
+        post = models.Blog.get(post_key)
+        if post:
+            post.score = (post.score or 0) + votes
+            post.comment_count = (post.comment_count or 0) + comments
+            rerank(post)
+            post.put()
+
+    if db.is_in_transaction():
+        txn()
+    else:
+        db.run_in_transaction(txn)
+
+
+def redecay():
+    # recomputes the hotness of the REDECAY_BATCH hottest posts. Decay
+    # only lowers hotness, so a post further down can only rise into
+    # this batch with a stale value, and the next run corrects it
+    keys = models.Blog.all(keys_only=True).order("-hotness") \
+                                          .fetch(REDECAY_BATCH)
+    for key in keys:
+        adjust(key)
+    logging.info("Re-decayed %d posts", len(keys))
+
+
+def rebuild(cursor=None, batch_size=50):
+    # recounts the score and comments of a batch of posts from the
+    # Like and Comment tables. Returns the cursor of the next batch,
+    # or None when done
+    query = models.Blog.all(keys_only=True)
+    if cursor:
+        query.with_cursor(cursor)
+    post_keys = query.fetch(batch_size)
+    for post_key in post_keys:
+        score = models.Like.count_likes(post_key.id())
+        comment_count = models.Comment.all(keys_only=True) \
+                                      .ancestor(post_key).count(None)
+
+        def txn():
+            post = models.Blog.get(post_key)
+            if post:
+                post.score = score
+                post.comment_count = comment_count
+                rerank(post)
+                post.put()
+
+        db.run_in_transaction(txn)
+    if len(post_keys) == batch_size:
+        return query.cursor()
+    return None
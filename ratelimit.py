@@ -0,0 +1,56 @@
+#######################################################
+# The ratelimit.py module throttles writes with token
+# buckets. A bucket holds up to `burst` tokens, refills
+# at `rate` tokens a second, and each request takes
+# one. Buckets live in memcache so every instance sees
+# the same counts. If memcache can't be used, each
+# instance falls back to its own in-process buckets.
+#######################################################
+
+import threading
+import time
+
+from google.appengine.api import memcache
+
+CAS_RETRIES = 3
+
+_local_buckets = {}
+_local_lock = threading.Lock()
+
+
+def refill(bucket, rate, burst, now):
+    tokens, updated = bucket
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def take(key, rate, burst):
+    # takes a token from the bucket named key; False if it's empty
+    now = time.time()
+    cache_key = "ratelimit:" + key
+    ttl = int(burst / rate) + 60
+    # a Client remembers the cas ids of its gets, so one shared by the
+    # request threads could cas with another thread's id
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        bucket = client.gets(cache_key)
+        if bucket is None:
+            if client.add(cache_key, (burst - 1, now), time=ttl):
+                return True
+            continue
+        tokens = refill(bucket, rate, burst, now)
+        if tokens < 1:
+            return False
+        if client.cas(cache_key, (tokens - 1, now), time=ttl):
+            return True
+    return take_local(key, rate, burst, now)
+
+
+def take_local(key, rate, burst, now):
+    with _local_lock:
+        bucket = _local_buckets.get(key, (burst, now))
+        tokens = refill(bucket, rate, burst, now)
+        if tokens < 1:
+            _local_buckets[key] = (tokens, now)
+            return False
+        _local_buckets[key] = (tokens - 1, now)
+        return True
@@ -0,0 +1,183 @@
+#######################################################
+# The search.py module is a full text search over posts
+# and their comments. Every post and comment has a
+# SearchDoc child entity listing its distinct terms in
+# an indexed list property, so the datastore index on
+# that property is the inverted index: querying a term
+# reads its posting list, newest documents first.
+# Documents are written one at a time as posts and
+# comments change, and deleted with their post.
+#######################################################
+
+import re
+import json
+import math
+import logging
+import models
+
+from google.appengine.ext import db
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""a an and are as at be but by for from has have
+    i in is it its of on or that the this to was were will with you""".split())
+
+TITLE_WEIGHT = 3
+COMMENT_WEIGHT = 0.5
+# bounds a document's index entries, whatever the length of the post
+MAX_TERMS = 300
+MAX_QUERY_TERMS = 5
+# posting lists are read a page of CANDIDATES_PER_TERM at a time, up
+# to MAX_CANDIDATES_PER_TERM, and at most MAX_MATCHES documents that
+# hold every term are read
+CANDIDATES_PER_TERM = 200
+MAX_CANDIDATES_PER_TERM = 2000
+MAX_MATCHES = 500
+
+
+class SearchDoc(db.Model):
+    # parent is the post; key_name is "post" for the post itself and
+    # "comment:<id>" for each comment
+    terms = db.StringListProperty()
+    weights = db.TextProperty()
+    date = db.DateTimeProperty()
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall(text.lower())
+            if len(t) > 1 and t not in STOPWORDS]
+
+
+def term_weights(*fields):
+    # fields are (text, weight) pairs; returns {term: weighted count}
+    weights = {}
+    for text, weight in fields:
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0) + weight
+    return weights
+
+
+def make_doc(parent_key, key_name, weights, date):
+    top = sorted(weights, key=weights.get, reverse=True)[:MAX_TERMS]
+    return SearchDoc(parent=parent_key, key_name=key_name, terms=top,
+                     weights=json.dumps(dict((t, weights[t]) for t in top)),
+                     date=date)
+
+
+def post_doc(post):
+    return make_doc(post.key(), "post",
+                    term_weights((post.title, TITLE_WEIGHT), (post.blog, 1)),
+                    post.date)
+
+
+def comment_doc(comment):
+    return make_doc(comment.key().parent(),
+                    "comment:%d" % comment.key().id(),
+                    term_weights((comment.body, COMMENT_WEIGHT)),
+                    comment.date)
+
+
+def index_post(post):
+    post_doc(post).put()
+
+
+def index_comment(comment):
+    comment_doc(comment).put()
+
+
+def unindex_comment(post_id, *comment_ids):
+    db.delete([db.Key.from_path("Blog", int(post_id),
+                                "SearchDoc", "comment:%d" % int(comment_id))
+               for comment_id in comment_ids])
+
+
+def term_query(term, before=None):
+    # a page of a term's posting list, newest first, optionally only
+    # the documents older than before
+    query = SearchDoc.all().filter("terms =", term)
+    if before:
+        query.filter("date <", before)
+    return query.order("-date")
+
+
+def search(query, limit=20):
+    # returns up to limit posts ranked by tf-idf. The candidates are
+    # the documents that hold every query term, however old, and the
+    # newest documents of each term's posting list. The lists are read
+    # a page at a time, all terms concurrently, and further pages only
+    # while fewer than limit posts have turned up
+    terms = []
+    for term in tokenize(query):
+        if term not in terms:
+            terms.append(term)
+    terms = terms[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+
+    matches = None
+    if len(terms) > 1:
+        # equality filters on the list property are a merge join of
+        # the posting lists in the built-in index, so no composite
+        # index is needed
+        every_term = SearchDoc.all()
+        for term in terms:
+            every_term.filter("terms =", term)
+        matches = every_term.run(limit=MAX_MATCHES)
+
+    docs = {}
+    read = dict((term, 0) for term in terms)
+    before = {}
+    unread = list(terms)
+    while unread:
+        runs = [(term, term_query(term, before.get(term))
+                 .run(limit=CANDIDATES_PER_TERM)) for term in unread]
+        for term, run in runs:
+            page = list(run)
+            read[term] += len(page)
+            docs.update((doc.key(), doc) for doc in page)
+            if page:
+                before[term] = page[-1].date
+            if len(page) < CANDIDATES_PER_TERM or \
+                    read[term] >= MAX_CANDIDATES_PER_TERM:
+                unread.remove(term)
+        if matches is not None:
+            docs.update((doc.key(), doc) for doc in matches)
+            matches = None
+        if len(set(key.parent() for key in docs)) >= limit:
+            break
+
+    idf = dict((term, math.log(1.0 + MAX_CANDIDATES_PER_TERM /
+                               float(read[term] or 1)))
+               for term in terms)
+    scores = {}
+    dates = {}
+    for doc in docs.values():
+        weights = json.loads(doc.weights)
+        post_key = doc.key().parent()
+        for term in terms:
+            tf = weights.get(term, 0)
+            if tf:
+                scores[post_key] = scores.get(post_key, 0) + \
+                    (1 + math.log(1 + tf)) * idf[term]
+        dates[post_key] = max(dates.get(post_key, doc.date), doc.date)
+
+    ranked = sorted(scores, key=lambda k: (scores[k], dates[k]),
+                    reverse=True)[:limit]
+    return filter(None, db.get(ranked))
+
+
+def build_index(cursor=None, batch_size=20):
+    # (re)indexes a batch of posts and all their comments. Returns the
+    # cursor of the next batch, or None when done
+    query = models.Blog.all()
+    if cursor:
+        query.with_cursor(cursor)
+    posts = query.fetch(batch_size)
+    for post in posts:
+        docs = [post_doc(post)]
+        docs.extend(comment_doc(c)
+                    for c in models.Comment.by_post(post.key().id()))
+        db.put(docs)
+    logging.info("Indexed %d posts for search", len(posts))
+    if len(posts) == batch_size:
+        return query.cursor()
+    return None
@@ -0,0 +1,80 @@
+#######################################################
+# The sessions.py module keeps an in-process cache that
+# maps a session token to the user it belongs to, so
+# repeat requests from a logged in user skip the
+# datastore lookup.
+#
+# Logging out deletes the Session entity and leaves a
+# revocation marker in memcache, which every instance
+# checks before trusting a cached token: one memcache
+# get, no datastore work. The marker outlives any entry
+# cached before the logout. If memcache loses it, other
+# instances can accept the token until their entry
+# expires (the TTL, 60 seconds).
+#######################################################
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+class LRUCache(object):
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+# session token -> (user key, username)
+cache = LRUCache(capacity=2000, ttl=60)
+
+
+def remember(token, user_key, username):
+    cache.set(token, (user_key, username))
+
+
+def revoked_key(token):
+    return "session-revoked:" + token
+
+
+def lookup(token):
+    session = cache.get(token)
+    if session and memcache.get(revoked_key(token)):
+        cache.delete(token)
+        return None
+    return session
+
+
+def forget(token):
+    cache.delete(token)
+
+
+def revoke(token):
+    # on logout: no instance accepts token from its cache after this.
+    # An instance that read the Session just before it was deleted
+    # can cache it a little later, so the marker is kept for two TTLs
+    memcache.set(revoked_key(token), True, time=2 * cache.ttl)
+    forget(token)
@@ -1,13 +1,22 @@
 #######################################################
 # The signup_helper.py module contains the methods that
-# validate forms and create password digests
+# validate forms, create password digests and session
+# tokens
 #######################################################
 
 import re
+import os
+import hmac
 import hashlib
+import binascii
 import random
 import string
 
+# cost of the password KDF. Raising it upgrades existing digests the
+# next time their owners log in
+PBKDF2_ITERATIONS = 100000
+PBKDF2_PREFIX = "pbkdf2_sha256"
+
 def validate_username(username):
     USERNAME_RE = re.compile(r"^[a-zA-Z0-9_-]{3,20}$")
     return username and re.match(USERNAME_RE, username)
@@ -24,10 +33,33 @@ def validate_email(email):
     EMAIL_RE = re.compile(r"^[\S]+@[\S]+.[\S]+$")
     return not email or EMAIL_RE.match(email)
 
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    # salted PBKDF2-SHA256, stored as "pbkdf2_sha256$iterations$salt$hash"
+    if salt is None:
+        salt = binascii.hexlify(os.urandom(16))
+    dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"),
+                             str(salt), iterations)
+    return "{0}${1}${2}${3}".format(PBKDF2_PREFIX, iterations, salt,
+                                    binascii.hexlify(dk))
+
+def needs_upgrade(password_digest):
+    # legacy sha256 digests and PBKDF2 digests with fewer iterations
+    # than PBKDF2_ITERATIONS are rehashed on the next login
+    parts = password_digest.split("$")
+    return parts[0] != PBKDF2_PREFIX or int(parts[1]) < PBKDF2_ITERATIONS
+
 def secure_str(username, password):
+    # legacy unsalted digest, only used to check old accounts
     h = hashlib.sha256(username+password).hexdigest()
     return "{0}|{1}".format(username, h)
 
 def validate_credentials(username, password, password_digest):
+    if password_digest.startswith(PBKDF2_PREFIX + "$"):
+        _, iterations, salt, _ = password_digest.split("$")
+        digest = hash_password(password, salt, int(iterations))
+        return hmac.compare_digest(str(digest), str(password_digest))
     h = password_digest.split('|')[1]
     return secure_str(username, password).split('|')[1] == h
+
+def new_session_token():
+    return binascii.hexlify(os.urandom(32))
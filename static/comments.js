@@ -0,0 +1,33 @@
+// Loads comments on demand: a thread's replies when its "replies"
+// button is clicked, and the next page of threads or replies. The
+// button or link is replaced by what comes back from its data-page
+// URL. Without JavaScript the "Older comments" link still works.
+(function () {
+  document.addEventListener("click", function (event) {
+    var button = event.target;
+    if (!button.classList || !button.classList.contains("load-more") ||
+        !button.getAttribute("data-page")) {
+      return;
+    }
+    event.preventDefault();
+    if (button.getAttribute("data-loading")) {
+      return;
+    }
+    button.setAttribute("data-loading", "true");
+    var request = new XMLHttpRequest();
+    request.open("GET", button.getAttribute("data-page"));
+    request.onload = function () {
+      if (request.status === 200) {
+        var page = JSON.parse(request.responseText);
+        button.insertAdjacentHTML("beforebegin", page.html);
+        button.parentNode.removeChild(button);
+      } else {
+        button.removeAttribute("data-loading");
+      }
+    };
+    request.onerror = function () {
+      button.removeAttribute("data-loading");
+    };
+    request.send();
+  });
+})();
@@ -0,0 +1,34 @@
+// Infinite scrolling for the blog index: when the "Older posts" link
+// comes into view, the next page is fetched from /blog/page.json and
+// put in its place. Without JavaScript the link still works.
+(function () {
+  var loading = false;
+
+  function loadNextPage() {
+    var link = document.querySelector(".older-posts");
+    if (!link || loading || !link.getAttribute("data-page")) {
+      return;
+    }
+    if (link.getBoundingClientRect().top > window.innerHeight + 200) {
+      return;
+    }
+    loading = true;
+    var request = new XMLHttpRequest();
+    request.open("GET", link.getAttribute("data-page"));
+    request.onload = function () {
+      if (request.status === 200) {
+        var page = JSON.parse(request.responseText);
+        link.insertAdjacentHTML("beforebegin", page.html);
+        link.parentNode.removeChild(link);
+      }
+      loading = false;
+    };
+    request.onerror = function () {
+      loading = false;
+    };
+    request.send();
+  }
+
+  window.addEventListener("scroll", loadNextPage);
+  window.addEventListener("load", loadNextPage);
+})();
@@ -0,0 +1,30 @@
+import testing
+
+import models
+
+
+class AnonymousAccessTest(testing.AppTestCase):
+    # the JSON endpoints behind a page are as private as the page
+
+    def setUp(self):
+        super(AnonymousAccessTest, self).setUp()
+        self.author, self.token = self.make_user("author")
+        self.post = self.make_post(self.author, title="Members only")
+
+    def assertSentToLogin(self, path):
+        response = self.request(path)
+        self.assertEqual(response.status_int, 302)
+        self.assertTrue(response.location.endswith("/blog/login"))
+        self.assertEqual(self.request(path, token=self.token).status_int,
+                         200)
+
+    def test_index_pages(self):
+        self.assertSentToLogin("/blog/page.json")
+
+    def test_comment_pages_and_replies(self):
+        comment = models.Comment.new(self.post, self.author, "A comment")
+        comment.put()
+        post_id = self.post.key().id()
+        self.assertSentToLogin("/blog/%d/comments.json" % post_id)
+        self.assertSentToLogin("/blog/%d/comment/%d/replies"
+                               % (post_id, comment.key().id()))
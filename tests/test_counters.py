@@ -0,0 +1,30 @@
+import testing
+
+import counters
+import models
+
+
+class ReconcileTest(testing.AppTestCase):
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        author = self.make_user("author")[0]
+        self.voters = [self.make_user("voter%d" % i)[0] for i in range(3)]
+        self.post = self.make_post(author)
+        self.post_id = self.post.key().id()
+        for voter, status in zip(self.voters, (True, True, False)):
+            counters.cast_vote(self.post, voter, status)
+
+    def test_counters_that_add_up_are_not_written(self):
+        self.rpcs.reset()
+        self.assertFalse(counters.reconcile(self.post_id))
+        self.assertEqual(self.rpcs.writes(), 0)
+        self.assertEqual(counters.get_count(self.post_id), 1)
+
+    def test_counters_that_are_off_are_corrected(self):
+        shards = [s for s in models.VoteShard.get(
+            counters.shard_keys(self.post_id)) if s]
+        shards[0].ups += 5
+        shards[0].put()
+        self.assertTrue(counters.reconcile(self.post_id))
+        self.assertEqual(counters.get_count(self.post_id), 1)
+        self.assertFalse(counters.reconcile(self.post_id))
@@ -0,0 +1,17 @@
+import unittest
+
+import testing
+
+import markup
+
+
+class LinkTest(unittest.TestCase):
+    def test_safe_links_are_kept(self):
+        for url in ("https://example.com/", "mailto:a@example.com",
+                    "/blog/1", "#comments"):
+            self.assertIn('href="%s"' % url,
+                          markup.render("[x](%s)" % url))
+
+    def test_links_off_site_in_disguise_are_dropped(self):
+        for url in ("javascript:alert(1)", "//evil.com", "/\\evil.com"):
+            self.assertNotIn("href", markup.render("[x](%s)" % url))
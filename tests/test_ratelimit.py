@@ -0,0 +1,57 @@
+import time
+
+import testing
+
+import blog
+import ratelimit
+
+
+class FrozenClock(object):
+    # stands in for the time module in ratelimit, so no tokens are
+    # refilled while the test runs
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+class BurstTest(testing.AppTestCase):
+    def setUp(self):
+        super(BurstTest, self).setUp()
+        ratelimit.time = FrozenClock()
+
+    def tearDown(self):
+        ratelimit.time = time
+        super(BurstTest, self).tearDown()
+
+    def test_votes_beyond_the_burst_are_refused_without_writes(self):
+        author, _ = self.make_user("author")
+        voter, token = self.make_user("voter")
+        rate, burst = blog.app.app.config["rate_limits"]["NewVote"]["user"]
+        posts = [self.make_post(author, title="Post %d" % i)
+                 for i in range(burst * 3)]
+
+        # the first vote is measured on its own for the writes it costs
+        self.rpcs.reset()
+        first = self.request("/blog/%d/vote/like" % posts[0].key().id(),
+                             post={}, token=token)
+        self.assertEqual(first.status_int, 302)
+        writes_per_vote = self.rpcs.writes()
+
+        self.rpcs.reset()
+        statuses = [self.request("/blog/%d/vote/like" % post.key().id(),
+                                 post={}, token=token).status_int
+                    for post in posts[1:]]
+        self.assertEqual(statuses.count(302), burst - 1)
+        self.assertEqual(statuses.count(429), len(posts) - burst)
+        self.assertLessEqual(self.rpcs.writes(),
+                             (burst - 1) * writes_per_vote)
+
+        # and once the bucket is empty, a request costs no datastore
+        # work at all
+        self.rpcs.reset()
+        response = self.request("/blog/%d/vote/like" % posts[0].key().id(),
+                                post={}, token=token)
+        self.assertEqual(response.status_int, 429)
+        self.assertEqual(self.rpcs.total(), 0)
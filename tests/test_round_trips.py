@@ -0,0 +1,63 @@
+import testing
+
+import models
+
+from google.appengine.api import memcache
+
+
+class RoundTripsTest(testing.AppTestCase):
+    # a page costs the same number of datastore round trips however
+    # many posts, comments and distinct authors are on it
+
+    def setUp(self):
+        super(RoundTripsTest, self).setUp()
+        self.viewer, self.token = self.make_user("viewer")
+        self.authors = [self.make_user("author%d" % i)[0] for i in range(60)]
+
+    def cold_rpcs(self, path):
+        # round trips of one request for path with nothing in memcache
+        memcache.flush_all()
+        self.rpcs.reset()
+        response = self.request(path, token=self.token)
+        self.assertEqual(response.status_int, 200)
+        return self.rpcs.round_trips
+
+    def post_with_comments(self, count):
+        post = self.make_post(self.authors[0])
+        for author in self.authors[:count]:
+            models.Comment.new(post, author, "A comment").put()
+        return post
+
+    def test_permalink(self):
+        few = self.post_with_comments(2)
+        many = self.post_with_comments(60)
+        # the first request also looks up the viewer's session
+        self.cold_rpcs("/blog/%d" % few.key().id())
+        self.assertEqual(self.cold_rpcs("/blog/%d" % few.key().id()),
+                         self.cold_rpcs("/blog/%d" % many.key().id()))
+
+    def test_replies(self):
+        post = self.make_post(self.authors[0])
+        few = models.Comment.new(post, self.authors[0], "Few replies")
+        many = models.Comment.new(post, self.authors[0], "Many replies")
+        models.db.put([few, many])
+        for i, author in enumerate(self.authors):
+            if i < 2:
+                models.Comment.new(post, author, "A reply", few).put()
+            models.Comment.new(post, author, "A reply", many).put()
+        path = "/blog/%d/comment/%d/replies" % (post.key().id(),
+                                                few.key().id())
+        self.cold_rpcs(path)
+        self.assertEqual(
+            self.cold_rpcs(path),
+            self.cold_rpcs("/blog/%d/comment/%d/replies"
+                           % (post.key().id(), many.key().id())))
+
+    def test_index(self):
+        for author in self.authors[:3]:
+            self.make_post(author)
+        self.cold_rpcs("/blog")
+        few = self.cold_rpcs("/blog")
+        for author in self.authors[3:]:
+            self.make_post(author)
+        self.assertEqual(few, self.cold_rpcs("/blog"))
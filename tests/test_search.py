@@ -0,0 +1,113 @@
+import datetime
+import os
+import random
+import time
+import unittest
+
+import testing
+
+import models
+import search
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+
+# the corpus size of the latency test, e.g. SEARCH_CORPUS=100000. It
+# takes a while to seed, so it only runs when asked for
+SEARCH_CORPUS = int(os.environ.get("SEARCH_CORPUS", 0))
+SEARCH_BUDGET_MS = float(os.environ.get("SEARCH_BUDGET_MS", 500))
+
+WORDS = ("alpha bravo charlie delta echo foxtrot golf hotel india juliet "
+         "kilo lima mike november oscar papa quebec romeo sierra tango "
+         "uniform victor whiskey xray yankee zulu").split()
+
+
+class SearchTest(testing.AppTestCase):
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.author = self.make_user("author")[0]
+        self.start = datetime.datetime(2016, 1, 1)
+
+    def add_posts(self, bodies, days_ago=0):
+        # indexes a post per body, in one batch, each a minute newer
+        # than the last
+        posts = []
+        for i, body in enumerate(bodies):
+            date = self.start + datetime.timedelta(days=-days_ago,
+                                                   minutes=i)
+            posts.append(models.Blog(title="Post", blog=body,
+                                     author=self.author, date=date))
+        db.put(posts)
+        db.put([search.post_doc(post) for post in posts])
+        return posts
+
+    def test_finds_an_old_post_holding_every_term(self):
+        old = self.add_posts(["zebra quantum"], days_ago=30)[0]
+        self.add_posts(["zebra"] * (search.CANDIDATES_PER_TERM + 50) +
+                       ["quantum"] * (search.CANDIDATES_PER_TERM + 50))
+        found = search.search("zebra quantum")
+        self.assertEqual(found[0].key(), old.key())
+
+    def test_reads_further_when_the_newest_documents_are_few_posts(self):
+        old = self.add_posts(["zebra"], days_ago=30)[0]
+        busy = self.add_posts(["a busy post"])[0]
+        comments = [models.Comment.new(busy, self.author, "zebra")
+                    for _ in range(search.CANDIDATES_PER_TERM + 50)]
+        db.put(comments)
+        db.put([search.comment_doc(c) for c in comments])
+        found = [post.key() for post in search.search("zebra")]
+        self.assertIn(old.key(), found)
+        self.assertIn(busy.key(), found)
+
+    def test_anonymous_searches_are_sent_to_login(self):
+        self.add_posts(["zebra"])
+        self.rpcs.reset()
+        response = self.request("/blog/search?q=zebra")
+        self.assertEqual(response.status_int, 302)
+        self.assertNotIn("zebra", response.body)
+        self.assertEqual(self.rpcs.total(), 0)
+
+
+@unittest.skipUnless(SEARCH_CORPUS, "set SEARCH_CORPUS to run")
+class SearchLatencyTest(testing.AppTestCase):
+    # query latency over a synthetic corpus of SEARCH_CORPUS posts, on
+    # the sqlite datastore stub, which has real indexes
+    QUERIES = 50
+
+    def setUp(self):
+        super(SearchLatencyTest, self).setUp()
+        self.testbed.deactivate()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(use_sqlite=True,
+                                            consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.rpcs = testing.RpcCounter()
+        author = self.make_user("author")[0]
+        rng = random.Random(1)
+        start = datetime.datetime(2016, 1, 1)
+        for first in range(0, SEARCH_CORPUS, 500):
+            posts = [models.Blog(title=" ".join(rng.sample(WORDS, 3)),
+                                 blog=" ".join(rng.choice(WORDS)
+                                               for _ in range(40)),
+                                 author=author,
+                                 date=start + datetime.timedelta(minutes=i))
+                     for i in range(first, min(first + 500, SEARCH_CORPUS))]
+            db.put(posts)
+            db.put([search.post_doc(post) for post in posts])
+        self.queries = [" ".join(rng.sample(WORDS, rng.randint(1, 3)))
+                        for _ in range(self.QUERIES)]
+
+    def test_latency(self):
+        times = []
+        for query in self.queries:
+            start = time.time()
+            search.search(query)
+            times.append((time.time() - start) * 1000)
+        times.sort()
+        p50 = times[len(times) // 2]
+        p95 = times[int(len(times) * 0.95)]
+        print("\nsearch over %d posts: p50 %.0f ms, p95 %.0f ms"
+              % (SEARCH_CORPUS, p50, p95))
+        self.assertLess(p95, SEARCH_BUDGET_MS)
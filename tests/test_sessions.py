@@ -0,0 +1,15 @@
+import testing
+
+import sessions
+
+
+class LogoutTest(testing.AppTestCase):
+    def test_logout_reaches_other_instances_caches(self):
+        user, token = self.make_user("reader")
+        self.assertEqual(self.request("/blog", token=token).status_int, 200)
+        self.request("/blog/logout", post={}, token=token)
+        # another instance still holds the token in its own cache
+        sessions.remember(token, user.key(), user.username)
+        response = self.request("/blog", token=token)
+        self.assertEqual(response.status_int, 302)
+        self.assertTrue(response.location.endswith("/blog/login"))
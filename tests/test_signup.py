@@ -0,0 +1,52 @@
+import threading
+
+import testing
+
+import models
+
+
+class ParallelSignupTest(testing.AppTestCase):
+    THREADS = 10
+
+    def in_parallel(self, target):
+        # runs target(i) on THREADS threads released at the same time
+        start = threading.Event()
+        results = [None] * self.THREADS
+
+        def run(i):
+            start.wait()
+            results[i] = target(i)
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def users_named(self, username):
+        return models.User.all().filter("username =", username).count()
+
+    def test_create(self):
+        users = self.in_parallel(
+            lambda i: models.User.create("alice", "digest-%d" % i))
+        self.assertEqual(len(filter(None, users)), 1)
+        self.assertEqual(self.users_named("alice"), 1)
+        self.assertEqual(models.User.by_username("alice").key(),
+                         filter(None, users)[0].key())
+
+    def test_signup_form(self):
+        # from different addresses, so the per-IP rate limit stays out
+        # of the way
+        form = {"username": "bob", "password": "secret",
+                "verify": "secret", "email": ""}
+        responses = self.in_parallel(
+            lambda i: self.request("/blog/signup", post=form,
+                                   remote_addr="10.0.1.%d" % i))
+        signed_up = [r for r in responses if r.status_int == 302]
+        self.assertEqual(len(signed_up), 1)
+        self.assertTrue(all("has already been taken" in r.body
+                            for r in responses if r.status_int != 302))
+        self.assertEqual(self.users_named("bob"), 1)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import testing
+
+import compile_templates
+import jinja2
+
+
+class CompiledTemplatesTest(unittest.TestCase):
+    # builds a copy of templates/ into a scratch directory
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+        self.saved = (compile_templates.template_dir,
+                      compile_templates.compiled_dir,
+                      compile_templates.digest_path)
+        template_dir = os.path.join(self.work, "templates")
+        shutil.copytree(os.path.join(testing.APP_DIR, "templates"),
+                        template_dir)
+        compile_templates.template_dir = template_dir
+        compile_templates.compiled_dir = os.path.join(self.work, "compiled")
+        compile_templates.digest_path = os.path.join(self.work, "compiled",
+                                                     "DIGEST")
+
+    def tearDown(self):
+        (compile_templates.template_dir, compile_templates.compiled_dir,
+         compile_templates.digest_path) = self.saved
+        shutil.rmtree(self.work)
+
+    def test_compiled_templates_render(self):
+        compile_templates.compile_all()
+        self.assertTrue(compile_templates.is_current())
+        env = jinja2.Environment(
+            loader=jinja2.ModuleLoader(compile_templates.compiled_dir),
+            autoescape=True)
+        env.globals["static_url"] = lambda path: "/static/" + path
+        self.assertIn("form", env.get_template("login.html").render())
+
+    def test_an_edited_template_makes_the_build_stale(self):
+        compile_templates.compile_all()
+        path = os.path.join(compile_templates.template_dir, "login.html")
+        with open(path, "a") as f:
+            f.write("\n")
+        self.assertFalse(compile_templates.is_current())
+
+    def test_no_build_is_not_current(self):
+        self.assertFalse(compile_templates.is_current())
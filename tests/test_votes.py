@@ -0,0 +1,31 @@
+import testing
+
+
+class NewVoteTest(testing.AppTestCase):
+    def setUp(self):
+        super(NewVoteTest, self).setUp()
+        self.author = self.make_user("author")[0]
+        self.voter, self.token = self.make_user("voter")
+        self.post = self.make_post(self.author, title="Vote on me")
+        self.path = "/blog/%d/vote/like" % self.post.key().id()
+
+    def test_a_vote_only_redirects(self):
+        response = self.request(self.path, post={}, token=self.token)
+        self.assertEqual(response.status_int, 302)
+        self.assertNotIn("Vote on me", response.body)
+
+    def test_a_second_like_renders_the_error(self):
+        self.request(self.path, post={}, token=self.token)
+        response = self.request(self.path, post={}, token=self.token)
+        self.assertEqual(response.status_int, 200)
+        self.assertIn("Already voted up", response.body)
+
+    def test_anonymous_votes_are_sent_to_login(self):
+        response = self.request(self.path, post={})
+        self.assertEqual(response.status_int, 302)
+        self.assertTrue(response.location.endswith("/blog/login"))
+
+    def test_a_vote_on_a_missing_post(self):
+        response = self.request("/blog/999999/vote/like", post={},
+                                token=self.token)
+        self.assertEqual(response.status_int, 200)
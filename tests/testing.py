@@ -0,0 +1,118 @@
+#######################################################
+# The testing.py module is shared by the tests. It puts
+# the app and the App Engine SDK's libraries on the
+# path, and has the base test case, which runs each
+# test against fresh testbed datastore, memcache and
+# task queue stubs and counts the datastore RPCs made.
+# Run the tests from the app directory with the SDK on
+# the PYTHONPATH:
+#
+#   python -m unittest discover -s tests
+#######################################################
+
+import collections
+import os
+import sys
+import threading
+import unittest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+try:
+    # adds webapp2, jinja2 and the SDK's other bundled libraries
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+import webapp2
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import testbed
+
+import blog
+import models
+import sessions
+
+WRITE_CALLS = ("Put", "Delete")
+
+
+class RpcCounter(object):
+    # counts datastore RPCs by call name, with the same API proxy hook
+    # profiling.py uses, and the round trips they took. The SDK splits
+    # a batch get over more than 10 entity groups into RPCs it sends
+    # at once; an RPC started while others are in flight shares their
+    # round trip
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.round_trips = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        hooks = apiproxy_stub_map.apiproxy
+        hooks.GetPreCallHooks().Append("rpc-counter", self._pre_call,
+                                       "datastore_v3")
+        hooks.GetPostCallHooks().Append("rpc-counter", self._post_call,
+                                        "datastore_v3")
+
+    def _pre_call(self, service, call, request, response, rpc=None):
+        with self._lock:
+            if not self._in_flight:
+                self.round_trips += 1
+            self._in_flight += 1
+
+    def _post_call(self, service, call, request, response, rpc=None,
+                   error=None):
+        with self._lock:
+            self.calls[call] += 1
+            self._in_flight -= 1
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.round_trips = 0
+
+    def total(self):
+        return sum(self.calls.values())
+
+    def writes(self):
+        return sum(self.calls[call] for call in WRITE_CALLS)
+
+
+class AppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # queries see every write at once, unless a test asks otherwise
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.rpcs = RpcCounter()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def make_user(self, username):
+        # returns the user and a session token that logs them in
+        user = models.User.create(username, "x")
+        token = "session-%s" % username
+        models.Session(key_name=token, user=user,
+                       username=username).put()
+        sessions.forget(token)
+        return user, token
+
+    def make_post(self, author, title="A post", body="Some text"):
+        post = models.Blog(title=title, blog=body, author=author)
+        post.render_body()
+        post.put()
+        return post
+
+    def request(self, path, post=None, token=None, remote_addr="10.0.0.1"):
+        headers = {}
+        if token:
+            headers["Cookie"] = "session=%s" % token
+        req = webapp2.Request.blank(path, POST=post, headers=headers,
+                                    remote_addr=remote_addr)
+        return req.get_response(blog.app)